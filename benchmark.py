@@ -0,0 +1,368 @@
+"""Load-replay benchmark for the edit-detection pipeline.
+
+Feeds synthetic pyrogram messages through the chat lanes into
+store_original_message and handle_edited_message, against a stub Telegram
+client and an in-memory storage backend. It then reports throughput, latency
+from submission to handler completion, and the number of storage and API
+calls per message.
+
+    python3 benchmark.py --messages 20000 --mix 70,20,8,2 --max-p99-ms 5
+
+With --micro it instead times content extraction and edit comparison per
+message kind, reporting nanoseconds and bytes allocated per call.
+"""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import timeit
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+# The bot reads its settings at import time, so point it at harmless values first
+os.environ["API_ID"] = os.environ.get("API_ID") or "1"
+os.environ["API_HASH"] = os.environ.get("API_HASH") or "benchmark"
+os.environ["BOT_TOKEN"] = os.environ.get("BOT_TOKEN") or "1:benchmark"
+os.environ["STORAGE_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = ":memory:"
+os.environ.setdefault("ACTION_BATCH_WINDOW", "0")
+
+from pyrogram.enums import ChatType, MessageMediaType
+from pyrogram.types import Chat, Location, Message, Photo, User
+
+import editguard
+from storage import StorageBackend
+
+OPERATIONS = ("new", "reaction", "content", "admin")
+
+class CountingBackend(StorageBackend):
+    """In-memory storage backend that counts calls and can simulate latency"""
+
+    supports_ttl = True
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.documents = {}
+        self.history = []
+        self.settings = {}
+
+    async def _call(self, method: str):
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def ping(self):
+        await self._call("ping")
+
+    async def ensure_indexes(self):
+        await self._call("ensure_indexes")
+
+    async def write_batch(self, documents: list):
+        await self._call("write_batch")
+        for document in documents:
+            self.documents[(document["chat_id"], document["message_id"])] = document
+
+    async def find(self, chat_id: int, message_id: int):
+        await self._call("find")
+        return self.documents.get((chat_id, message_id))
+
+    async def purge_expired(self, batch_size: int) -> int:
+        await self._call("purge_expired")
+        return 0
+
+    async def write_history(self, records: list):
+        await self._call("write_history")
+        self.history.extend(records)
+
+    async def find_history(self, chat_id: int, message_id: int = None, limit: int = 10) -> list:
+        await self._call("find_history")
+        records = [
+            record for record in reversed(self.history)
+            if record["chat_id"] == chat_id and message_id in (None, record["message_id"])
+        ]
+        return records[:limit]
+
+    async def load_settings(self) -> dict:
+        await self._call("load_settings")
+        return dict(self.settings)
+
+    async def save_settings(self, chat_id: int, settings: dict):
+        await self._call("save_settings")
+        self.settings[chat_id] = settings
+
+class StubMember:
+    def __init__(self, user: User):
+        self.user = user
+
+class StubClient:
+    """Stand-in for the pyrogram Client that counts Telegram API calls"""
+
+    def __init__(self, admins: dict, latency: float = 0.0):
+        self.admins = admins
+        self.latency = latency
+        self.calls = Counter()
+        self.me = User(id=1, first_name="EditGuard", username="editguard_bot", is_bot=True)
+
+    async def _call(self, method: str):
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def get_me(self):
+        await self._call("get_me")
+        return self.me
+
+    async def get_chat_members(self, chat_id: int, filter=None):
+        await self._call("get_chat_members")
+        for user in self.admins.get(chat_id, ()):
+            yield StubMember(user)
+
+    async def delete_messages(self, chat_id: int, message_ids: list):
+        await self._call("delete_messages")
+        return len(message_ids)
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        await self._call("send_message")
+
+def make_message(chat: Chat, message_id: int, user: User, text: str, edited: bool = False) -> Message:
+    """Build a synthetic text message, optionally marked as edited"""
+    now = datetime.now()
+    return Message(
+        id=message_id,
+        chat=chat,
+        from_user=user,
+        date=now,
+        edit_date=now if edited else None,
+        text=text
+    )
+
+def build_workload(args) -> tuple:
+    """Generate (operation, message) pairs following the requested mix"""
+    rng = random.Random(args.seed)
+    weights = [float(part) for part in args.mix.split(",")]
+
+    chats = [Chat(id=-1000000000000 - i, type=ChatType.SUPERGROUP, title=f"Bench {i}") for i in range(args.chats)]
+    users = [User(id=1000 + i, first_name=f"User{i}") for i in range(args.users)]
+    admins = {chat.id: rng.sample(users, max(1, args.users // 20)) for chat in chats}
+
+    workload = []
+    stored = []
+    next_id = Counter()
+
+    for _ in range(args.messages):
+        operation = rng.choices(OPERATIONS, weights)[0] if stored else "new"
+        if operation == "new":
+            chat = rng.choice(chats)
+            next_id[chat.id] += 1
+            user = rng.choice(users)
+            message = make_message(chat, next_id[chat.id], user, f"message {next_id[chat.id]} in {chat.id}")
+            stored.append(message)
+        else:
+            original = rng.choice(stored)
+            chat = original.chat
+            if operation == "admin":
+                user = rng.choice(admins[chat.id])
+            elif original.from_user in admins[chat.id]:
+                user = next(u for u in users if u not in admins[chat.id])
+            else:
+                user = original.from_user
+            text = original.text if operation == "reaction" else f"{original.text} (edited {rng.random():.6f})"
+            message = make_message(chat, original.id, user, text, edited=operation != "reaction")
+        workload.append((operation, message))
+
+    return workload, admins
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+async def run(args) -> dict:
+    workload, admins = build_workload(args)
+
+    backend = CountingBackend(args.storage_latency_ms / 1000)
+    client = StubClient(admins, args.api_latency_ms / 1000)
+    editguard.storage = backend
+    editguard.app = client
+    editguard.action_scheduler.client = client
+    await editguard.BotIdentity.load(client)
+
+    lanes = editguard.chat_lanes = editguard.ChatLanes(args.lanes, args.queue_size, args.overflow_policy)
+    latencies = {operation: [] for operation in OPERATIONS}
+
+    def timed(operation: str, handler):
+        """Handler body that records the time from submission to completion"""
+        @functools.wraps(handler)
+        async def run(client, submitted: float, message: Message):
+            await handler(client, message)
+            latencies[operation].append(time.perf_counter() - submitted)
+        return run
+
+    handlers = {
+        operation: timed(operation, (editguard.store_original_message if operation == "new" else editguard.handle_edited_message).__wrapped__)
+        for operation in OPERATIONS
+    }
+
+    # Feed updates one at a time like pyrogram's single dispatcher worker, through the same lanes
+    started = time.perf_counter()
+    for operation, message in workload:
+        await lanes.submit(message.chat.id, handlers[operation], client, time.perf_counter(), message, edit=operation != "new")
+    await lanes.drain()
+    handled = time.perf_counter() - started
+    await lanes.stop()
+
+    # Include the deferred work the handlers queued up
+    await editguard.action_scheduler.drain()
+    await editguard.MessageStorage.flush()
+    await editguard.EditJournal.flush()
+    elapsed = time.perf_counter() - started
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        "messages": len(workload),
+        "mix": dict(Counter(operation for operation, _ in workload)),
+        "messages_per_sec": len(workload) / handled if handled else 0.0,
+        "elapsed_sec": elapsed,
+        "p50_ms": percentile(all_latencies, 0.50) * 1000,
+        "p99_ms": percentile(all_latencies, 0.99) * 1000,
+        "latency_ms": {
+            operation: {
+                "p50": percentile(values, 0.50) * 1000,
+                "p99": percentile(values, 0.99) * 1000,
+                "mean": statistics.fmean(values) * 1000 if values else 0.0
+            }
+            for operation, values in latencies.items()
+        },
+        "lookups_avoided": editguard.LOOKUPS_AVOIDED.total(),
+        "updates_dropped": editguard.UPDATES_DROPPED.total(),
+        "storage_calls_per_message": sum(backend.calls.values()) / len(workload),
+        "api_calls_per_message": sum(client.calls.values()) / len(workload),
+        "storage_calls": dict(backend.calls),
+        "api_calls": dict(client.calls)
+    }
+
+def micro_messages() -> dict:
+    """One representative message per content kind"""
+    chat = Chat(id=-1000000000000, type=ChatType.SUPERGROUP, title="Micro")
+    user = User(id=1000, first_name="User")
+    now = datetime.now()
+    photo = Photo(
+        file_id="AgACAgIAAxkBAAIBbWVrY2hhbmdlZAACQ8gxG0",
+        file_unique_id="AQADQ8gxG0",
+        width=1280,
+        height=720,
+        file_size=123456,
+        date=now
+    )
+    return {
+        "text": Message(id=1, chat=chat, from_user=user, date=now, text="just a plain text message " * 4),
+        "photo": Message(id=2, chat=chat, from_user=user, date=now, caption="a caption", media=MessageMediaType.PHOTO, photo=photo),
+        "location": Message(id=3, chat=chat, from_user=user, date=now, media=MessageMediaType.LOCATION, location=Location(latitude=52.52, longitude=13.405))
+    }
+
+def measure(function, number: int) -> tuple:
+    """Nanoseconds per call and bytes held by each call's result"""
+    elapsed = min(timeit.repeat(function, number=number, repeat=5))
+    tracemalloc.start()
+    results = [function() for _ in range(1000)]
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del results
+    return elapsed / number * 1e9, allocated / 1000
+
+def run_micro(args) -> dict:
+    snapshot_class = editguard.MessageSnapshot
+    result = {}
+    for kind, message in micro_messages().items():
+        snapshot = snapshot_class.from_message(message)
+        full = {"text": snapshot.text, "media_type": snapshot.media_type, "has_media": snapshot.has_media, "file_id": snapshot.file_id}
+        compact = {"h": snapshot.digest()}
+        cases = {
+            "extract": lambda: snapshot_class.from_message(message),
+            "compare_full": lambda: editguard.is_content_edited(full, snapshot),
+            "compare_compact": lambda: editguard.is_content_edited(compact, snapshot)
+        }
+        result[kind] = {}
+        for case, function in cases.items():
+            ns, allocated = measure(function, args.micro_iterations)
+            result[kind][case] = {"ns_per_call": ns, "bytes_per_call": allocated}
+    return result
+
+def print_micro_report(result: dict):
+    for kind, cases in result.items():
+        for case, timing in cases.items():
+            print(f"{kind:<9} {case:<16} {timing['ns_per_call']:8.0f} ns/call, {timing['bytes_per_call']:6.1f} B/call")
+
+def print_report(result: dict):
+    print(f"📨 Messages:           {result['messages']} {result['mix']}")
+    print(f"⚡ Throughput:         {result['messages_per_sec']:.0f} messages/sec")
+    print(f"⏱️ Handler latency:    p50 {result['p50_ms']:.3f} ms, p99 {result['p99_ms']:.3f} ms")
+    for operation, latency in result["latency_ms"].items():
+        print(f"   {operation:<9} p50 {latency['p50']:.3f} ms, p99 {latency['p99']:.3f} ms, mean {latency['mean']:.3f} ms")
+    print(f"🗄️ Storage calls/msg:  {result['storage_calls_per_message']:.3f} {result['storage_calls']}")
+    print(f"🪶 Lookups avoided:    {result['lookups_avoided']:g}")
+    print(f"📥 Updates shed:       {result['updates_dropped']:g}")
+    print(f"📡 API calls/msg:      {result['api_calls_per_message']:.3f} {result['api_calls']}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the edit-detection pipeline")
+    parser.add_argument("--messages", type=int, default=10000, help="number of updates to replay")
+    parser.add_argument("--mix", default="70,20,8,2", help="weights for new,reaction,content,admin updates")
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--lanes", type=int, default=editguard.UPDATE_LANES, help="handler lanes, as UPDATE_LANES")
+    parser.add_argument("--queue-size", type=int, default=editguard.UPDATE_QUEUE_SIZE, help="updates queued across lanes, as UPDATE_QUEUE_SIZE")
+    parser.add_argument("--overflow-policy", default=editguard.UPDATE_OVERFLOW_POLICY, choices=editguard.ChatLanes.OVERFLOW_POLICIES)
+    parser.add_argument("--storage-latency-ms", type=float, default=0.0, help="simulated storage round trip")
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="simulated Telegram round trip")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--micro", action="store_true", help="time content extraction and comparison instead of replaying updates")
+    parser.add_argument("--micro-iterations", type=int, default=100000)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--max-p99-ms", type=float, help="fail if p99 handler latency is higher")
+    parser.add_argument("--min-throughput", type=float, help="fail if messages/sec is lower")
+    parser.add_argument("--max-storage-calls", type=float, help="fail if storage calls per message are higher")
+    parser.add_argument("--max-api-calls", type=float, help="fail if API calls per message are higher")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if args.micro:
+        result = run_micro(args)
+        if args.json:
+            print(json.dumps(result, indent=2))
+        else:
+            print_micro_report(result)
+        return
+
+    result = asyncio.run(run(args))
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+
+    failures = []
+    if args.max_p99_ms is not None and result["p99_ms"] > args.max_p99_ms:
+        failures.append(f"p99 {result['p99_ms']:.3f} ms > {args.max_p99_ms} ms")
+    if args.min_throughput is not None and result["messages_per_sec"] < args.min_throughput:
+        failures.append(f"throughput {result['messages_per_sec']:.0f}/s < {args.min_throughput}/s")
+    if args.max_storage_calls is not None and result["storage_calls_per_message"] > args.max_storage_calls:
+        failures.append(f"storage calls/msg {result['storage_calls_per_message']:.3f} > {args.max_storage_calls}")
+    if args.max_api_calls is not None and result["api_calls_per_message"] > args.max_api_calls:
+        failures.append(f"API calls/msg {result['api_calls_per_message']:.3f} > {args.max_api_calls}")
+
+    for failure in failures:
+        print(f"❌ Regression: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
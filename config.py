@@ -9,3 +9,72 @@ API_ID = int(getenv("API_ID"))
 API_HASH = getenv("API_HASH")
 BOT_TOKEN = getenv("BOT_TOKEN")
 MONGODB_URI = getenv("MONGODB_URI")
+
+# Write-behind buffer for message snapshots
+WRITE_BATCH_SIZE = int(getenv("WRITE_BATCH_SIZE", "500"))
+WRITE_FLUSH_INTERVAL = float(getenv("WRITE_FLUSH_INTERVAL", "1.0"))
+
+# In-memory cache of recent message snapshots
+CACHE_MAX_ENTRIES = int(getenv("CACHE_MAX_ENTRIES", "100000"))
+CACHE_MAX_MB = float(getenv("CACHE_MAX_MB", "64"))
+CACHE_TTL = float(getenv("CACHE_TTL", "3600"))
+
+# Per-chat administrator cache
+ADMIN_CACHE_TTL = float(getenv("ADMIN_CACHE_TTL", "600"))
+
+# Per-chat action scheduler for deletions and notifications
+ACTION_BATCH_WINDOW = float(getenv("ACTION_BATCH_WINDOW", "1.0"))
+CHAT_ACTIONS_PER_MINUTE = float(getenv("CHAT_ACTIONS_PER_MINUTE", "20"))
+CHAT_ACTION_BURST = int(getenv("CHAT_ACTION_BURST", "5"))
+
+# Snapshot retention: days to keep messages, optionally overridden per chat
+# with "chat_id:days" pairs, e.g. CHAT_RETENTION_DAYS=-1001234567890:1,-1009876543210:3
+RETENTION_DAYS = float(getenv("RETENTION_DAYS", "7"))
+CHAT_RETENTION_DAYS = {
+    int(chat_id): float(days)
+    for chat_id, days in (pair.split(":") for pair in getenv("CHAT_RETENTION_DAYS", "").split(",") if pair)
+}
+# Let MongoDB expire snapshots with a TTL index; otherwise purge them in batches
+USE_TTL_INDEX = getenv("USE_TTL_INDEX", "true").lower() == "true"
+PURGE_BATCH_SIZE = int(getenv("PURGE_BATCH_SIZE", "1000"))
+PURGE_INTERVAL = float(getenv("PURGE_INTERVAL", "3600"))
+
+# Store a content digest with short field names instead of the full message content
+COMPACT_SNAPSHOTS = getenv("COMPACT_SNAPSHOTS", "false").lower() == "true"
+
+# Storage backend: "mongo" (MONGODB_URI) or "sqlite" (embedded, SQLITE_PATH)
+STORAGE_BACKEND = getenv("STORAGE_BACKEND", "mongo").lower()
+SQLITE_PATH = getenv("SQLITE_PATH", "editguard.db")
+
+# Prometheus-style metrics endpoint (set METRICS_PORT=0 to disable)
+METRICS_HOST = getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(getenv("METRICS_PORT", "9464"))
+
+# Seconds between saves of the per-chat message counters
+STATS_PERSIST_INTERVAL = float(getenv("STATS_PERSIST_INTERVAL", "60"))
+
+# Chats where the bot neither stores nor checks messages, e.g. DISABLED_CHATS=-1001234567890,-1009876543210
+DISABLED_CHATS = {int(chat_id) for chat_id in getenv("DISABLED_CHATS", "").split(",") if chat_id}
+
+# Sharded multi-worker mode: one process receives updates and routes them to WORKERS
+# worker processes, each owning a share of the chats. WORKER_ID is set for each worker.
+WORKERS = int(getenv("WORKERS", "1"))
+WORKER_ID = int(getenv("WORKER_ID")) if getenv("WORKER_ID") else None
+# Sequential in-process lanes that run handlers, each chat always on the same lane
+UPDATE_LANES = int(getenv("UPDATE_LANES", "8"))
+# Updates allowed to wait across all lanes, and what to do when a lane is full:
+# "block" waits (backpressure), "drop_edits" sheds edited-message updates (even from other chats on the lane),
+# "degrade" waits but stops posting deletion notifications until the lanes catch up.
+# Edits are also dropped on arrival once this many updates are waiting for the dispatcher
+UPDATE_QUEUE_SIZE = int(getenv("UPDATE_QUEUE_SIZE", "10000"))
+UPDATE_OVERFLOW_POLICY = getenv("UPDATE_OVERFLOW_POLICY", "degrade").lower()
+# Journal every handled edit so admins can review it with /history; records expire with the chat's retention
+EDIT_HISTORY = getenv("EDIT_HISTORY", "true").lower() == "true"
+HISTORY_LIMIT = int(getenv("HISTORY_LIMIT", "10"))
+# Local file the hot caches are saved to on shutdown and reloaded from on startup (empty disables it)
+STATE_FILE = getenv("STATE_FILE", "editguard.state")
+# Seconds to spend finishing queued updates and deletions on shutdown before writing everything out.
+# Keep it below your supervisor's kill grace period (10s for Docker)
+SHUTDOWN_TIMEOUT = float(getenv("SHUTDOWN_TIMEOUT", "8"))
+# User allowed to run /cleanup and /stats
+OWNER_ID = int(getenv("OWNER_ID", "6878311635"))
@@ -1,266 +1,1201 @@
 import asyncio
-from pyrogram import Client, filters
-from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
-from pyrogram.enums import ParseMode, ChatMemberStatus, MessageMediaType
-from pyrogram.errors import MessageDeleteForbidden, ChatAdminRequired
+import functools
+import hashlib
+import html
+import os
+import pickle
+import signal
+import sys
+import time
+from collections import OrderedDict
+from io import BytesIO
+from pyrogram import Client, filters, idle, utils, StopPropagation
+from pyrogram.raw.core import TLObject, Vector
+from pyrogram.raw.types import UpdateEditMessage, UpdateEditChannelMessage
+from pyrogram.types import Message, ChatMemberUpdated, InlineKeyboardMarkup, InlineKeyboardButton
+from pyrogram.enums import ParseMode, ChatMemberStatus, ChatMembersFilter, MessageMediaType, MessageEntityType
+from pyrogram.errors import MessageDeleteForbidden, ChatAdminRequired, FloodWait
 import logging
 from datetime import datetime, timedelta
-import motor.motor_asyncio
-from config import API_ID, API_HASH, BOT_TOKEN, MONGODB_URI
+from storage import create_backend
+from metrics import Counter, Gauge, Histogram, start_metrics_server
+from config import (
+    API_ID, API_HASH, BOT_TOKEN, MONGODB_URI, STORAGE_BACKEND, SQLITE_PATH,
+    WRITE_BATCH_SIZE, WRITE_FLUSH_INTERVAL,
+    CACHE_MAX_ENTRIES, CACHE_MAX_MB, CACHE_TTL,
+    ADMIN_CACHE_TTL,
+    ACTION_BATCH_WINDOW, CHAT_ACTIONS_PER_MINUTE, CHAT_ACTION_BURST,
+    RETENTION_DAYS, CHAT_RETENTION_DAYS, USE_TTL_INDEX, PURGE_BATCH_SIZE, PURGE_INTERVAL,
+    COMPACT_SNAPSHOTS,
+    METRICS_HOST, METRICS_PORT,
+    STATS_PERSIST_INTERVAL,
+    DISABLED_CHATS,
+    WORKERS, WORKER_ID, UPDATE_LANES, UPDATE_QUEUE_SIZE, UPDATE_OVERFLOW_POLICY,
+    EDIT_HISTORY, HISTORY_LIMIT,
+    STATE_FILE, SHUTDOWN_TIMEOUT,
+    OWNER_ID
+)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Create the bot client
-app = Client("edit_delete_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+# Metrics
+HANDLER_LATENCY = Histogram("editguard_handler_seconds", "Time spent in update handlers", ("handler",))
+STORAGE_LATENCY = Histogram("editguard_storage_seconds", "Storage backend call latency", ("operation",))
+API_LATENCY = Histogram("editguard_telegram_api_seconds", "Telegram API call latency", ("method",))
+FLOOD_WAITS = Counter("editguard_flood_waits_total", "FloodWait errors received from Telegram", ("method",))
+STORED_MESSAGES = Counter("editguard_stored_messages_total", "Message snapshots stored")
+EDIT_OUTCOMES = Counter("editguard_edits_total", "Edited message updates by outcome", ("outcome",))
+DELETED_MESSAGES = Counter("editguard_deleted_messages_total", "Edited messages deleted")
+NOTIFICATIONS_SENT = Counter("editguard_notifications_total", "Deletion notifications sent")
+NOTIFICATIONS_SUPPRESSED = Counter("editguard_notifications_suppressed_total", "Deletion notifications not sent", ("reason",))
+UPDATES_DROPPED = Counter("editguard_updates_dropped_total", "Updates shed because their lane was backed up", ("reason",))
+LOOKUPS_AVOIDED = Counter("editguard_lookups_avoided_total", "Edited message updates recognised as non-content without a storage lookup", ("reason",))
+HISTORY_RECORDS = Counter("editguard_history_records_total", "Edit records appended to the journal", ("action",))
+STORE_SKIPS = Counter("editguard_store_skips_total", "Messages not stored because they can never be edit-checked", ("reason",))
 
-# MongoDB setup
-client = motor.motor_asyncio.AsyncIOMotorClient(MONGODB_URI)
-db = client.editguard_bot
-messages_collection = db.messages
+# In sharded mode each worker process owns the chats that hash to it
+SHARDED = WORKERS > 1 and WORKER_ID is not None
+WORKER_INDEX = WORKER_ID or 0
 
-class MessageStorage:
-    """MongoDB-based message storage"""
+@functools.lru_cache(maxsize=65536)
+def shard_for(chat_id: int, shards: int) -> int:
+    """Rendezvous hash of a chat onto one of `shards` workers, stable across processes and restarts"""
+    return max(
+        range(shards),
+        key=lambda shard: hashlib.blake2b(f"{chat_id}:{shard}".encode(), digest_size=8).digest()
+    )
+
+def owns_chat(chat_id: int) -> bool:
+    """Whether this process handles updates for a chat"""
+    return not SHARDED or shard_for(chat_id, WORKERS) == WORKER_INDEX
+
+def worker_path(path: str) -> str:
+    """Give each sharded worker its own copy of a local file"""
+    if not SHARDED or path == ":memory:":
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{WORKER_INDEX}{ext}"
+
+# Create the bot client. Handlers only queue updates on chat lanes, so a single
+# dispatcher worker is enough and keeps every chat's updates in arrival order.
+# Sharded workers get their updates from the receiving process and only use
+# their own session for API calls.
+app = Client(
+    f"edit_delete_bot_{WORKER_INDEX}" if SHARDED else "edit_delete_bot",
+    api_id=API_ID,
+    api_hash=API_HASH,
+    bot_token=BOT_TOKEN,
+    workers=1,
+    no_updates=SHARDED
+)
+
+# Storage backend setup (MongoDB or embedded SQLite)
+storage = create_backend(
+    STORAGE_BACKEND,
+    mongodb_uri=MONGODB_URI,
+    sqlite_path=worker_path(SQLITE_PATH),
+    default_retention=timedelta(days=RETENTION_DAYS),
+    use_ttl_index=USE_TTL_INDEX
+)
+
+class MessageCache:
+    """Bounded in-memory LRU cache of recent snapshots with a time-to-live"""
+    
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.size_bytes = 0
+        # (chat_id, message_id) -> (expires_at, size, document), oldest first
+        self._entries = OrderedDict()
+    
+    def __len__(self):
+        return len(self._entries)
     
     @staticmethod
-    async def store_message(message_id: int, text: str, user_id: int, chat_id: int, media_type: str = None, has_media: bool = False, file_id: str = None):
-        """Store original message in MongoDB"""
+    def _estimate_size(document: dict) -> int:
+        """Rough memory footprint of a snapshot document"""
+        return sys.getsizeof(document) + sum(sys.getsizeof(value) for value in document.values())
+    
+    def get(self, key: tuple):
+        """Return a cached snapshot and mark it as recently used"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        
+        expires_at, _, document = entry
+        if expires_at < time.monotonic():
+            self.pop(key)
+            self.misses += 1
+            return None
+        
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return document
+    
+    def put(self, key: tuple, document: dict, ttl: float = None):
+        """Cache a snapshot, evicting least recently used entries over budget"""
+        self.pop(key)
+        size = self._estimate_size(document)
+        self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), size, document)
+        self.size_bytes += size
+        
+        while self._entries and (len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes):
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self.size_bytes -= evicted_size
+    
+    def peek(self, key: tuple):
+        """Return a cached snapshot without touching recency or hit statistics"""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[2]
+    
+    def pop(self, key: tuple):
+        """Drop a snapshot from the cache and return it"""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size_bytes -= entry[1]
+            return entry[2]
+        return None
+    
+    def dump(self) -> list:
+        """Unexpired entries as (key, seconds left, document), oldest first"""
+        now = time.monotonic()
+        return [(key, expires_at - now, document) for key, (expires_at, _, document) in self._entries.items() if expires_at > now]
+    
+    def restore(self, entries: list, elapsed: float) -> int:
+        """Re-add dumped entries, less the time spent while the bot was down"""
+        restored = 0
+        for key, remaining, document in entries:
+            if remaining > elapsed:
+                self.put(key, document, remaining - elapsed)
+                restored += 1
+        return restored
+    
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+message_cache = MessageCache(CACHE_MAX_ENTRIES, int(CACHE_MAX_MB * 1024 * 1024), CACHE_TTL)
+
+Gauge("editguard_cache_entries", "Snapshots held in the in-memory cache", function=lambda: len(message_cache))
+Gauge("editguard_cache_bytes", "Estimated memory used by the snapshot cache", function=lambda: message_cache.size_bytes)
+Counter("editguard_cache_hits_total", "Snapshot cache hits", function=lambda: message_cache.hits)
+Counter("editguard_cache_misses_total", "Snapshot cache misses", function=lambda: message_cache.misses)
+
+class ChatCounters:
+    """Per-chat snapshot counts maintained alongside writes, bucketed by expiry hour"""
+    
+    def __init__(self):
+        # chat_id -> {expiry hour: number of snapshots expiring in that hour}
+        self._buckets = {}
+        self.titles = {}
+        self._dirty = set()
+    
+    @staticmethod
+    def _hour(moment: datetime) -> int:
+        return int((moment - datetime(1970, 1, 1)).total_seconds() // 3600)
+    
+    def _current_hour(self) -> int:
+        return self._hour(datetime.utcnow())
+    
+    def _prune(self, chat_id: int, buckets: dict, current_hour: int) -> dict:
+        """Drop buckets whose snapshots have expired by now"""
+        for hour in [hour for hour in buckets if hour < current_hour]:
+            del buckets[hour]
+            self._dirty.add(chat_id)
+        return buckets
+    
+    def record_store(self, chat_id: int, expire_at: datetime):
+        """Count a newly stored snapshot"""
+        buckets = self._buckets.setdefault(chat_id, {})
+        hour = self._hour(expire_at)
+        buckets[hour] = buckets.get(hour, 0) + 1
+        self._dirty.add(chat_id)
+    
+    def record_restore(self, chat_id: int, old_expire_at: datetime, new_expire_at: datetime):
+        """Move a snapshot stored again with a new expiry from its old hour to the new one"""
+        old_hour = self._hour(old_expire_at)
+        if old_hour == self._hour(new_expire_at):
+            return
+        buckets = self._buckets.setdefault(chat_id, {})
+        # The old bucket is gone if it already expired, in which case the snapshot only counts from now on
+        if buckets.get(old_hour):
+            buckets[old_hour] -= 1
+            if not buckets[old_hour]:
+                del buckets[old_hour]
+        self.record_store(chat_id, new_expire_at)
+    
+    def set_title(self, chat_id: int, title: str):
+        if title and self.titles.get(chat_id) != title:
+            self.titles[chat_id] = title
+            self._dirty.add(chat_id)
+    
+    def count(self, chat_id: int) -> int:
+        """Unexpired snapshots stored for a chat"""
+        buckets = self._buckets.get(chat_id)
+        if not buckets:
+            return 0
+        return sum(self._prune(chat_id, buckets, self._current_hour()).values())
+    
+    def total(self) -> int:
+        return sum(self.count(chat_id) for chat_id in list(self._buckets))
+    
+    def top(self, limit: int) -> list:
+        """(chat_id, count) pairs for the chats with the most snapshots"""
+        counts = [(chat_id, self.count(chat_id)) for chat_id in list(self._buckets)]
+        return sorted((item for item in counts if item[1]), key=lambda item: item[1], reverse=True)[:limit]
+    
+    def load(self, counters: dict):
+        """Replace the in-memory counters with persisted ones"""
+        self._buckets = {chat_id: dict(chat["buckets"]) for chat_id, chat in counters.items()}
+        self.titles = {chat_id: chat["title"] for chat_id, chat in counters.items() if chat.get("title")}
+        self._dirty.clear()
+    
+    async def persist(self):
+        """Save the counters of chats that changed since the last save"""
+        if not self._dirty:
+            return
+        
+        dirty, self._dirty = self._dirty, set()
+        current_hour = self._current_hour()
+        try:
+            await storage.save_counters({
+                chat_id: {
+                    "title": self.titles.get(chat_id),
+                    "buckets": dict(self._prune(chat_id, self._buckets.get(chat_id, {}), current_hour))
+                }
+                for chat_id in dirty
+            })
+        except Exception as e:
+            logger.error(f"Error saving chat counters: {e}")
+            self._dirty |= dirty
+
+chat_counters = ChatCounters()
+
+NOTIFY_MODES = ("each", "batched", "silent")
+
+class ChatSettings:
+    """Settings a chat's admins can change, the defaults apply to chats that changed nothing"""
+    
+    __slots__ = ("retention_days", "exempt_users", "notify", "enabled")
+    
+    def __init__(self, retention_days: float = None, exempt_users: frozenset = frozenset(), notify: str = "batched", enabled: bool = True):
+        # None keeps the retention from CHAT_RETENTION_DAYS/RETENTION_DAYS
+        self.retention_days = retention_days
+        self.exempt_users = frozenset(exempt_users)
+        self.notify = notify
+        self.enabled = enabled
+    
+    def replace(self, **changes) -> "ChatSettings":
+        """Copy with some settings changed, the cached instance is never mutated"""
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(changes)
+        return ChatSettings(**values)
+    
+    def to_document(self) -> dict:
+        return {
+            "retention_days": self.retention_days,
+            "exempt_users": sorted(self.exempt_users),
+            "notify": self.notify,
+            "enabled": self.enabled
+        }
+    
+    @classmethod
+    def from_document(cls, document: dict) -> "ChatSettings":
+        return cls(**{name: document[name] for name in cls.__slots__ if name in document})
+
+class ChatSettingsCache:
+    """Write-through cache of every chat's settings, so the hot path never waits on storage"""
+    
+    def __init__(self):
+        self.default = ChatSettings()
+        self._settings = {}
+    
+    def __len__(self):
+        return len(self._settings)
+    
+    def get(self, chat_id: int) -> ChatSettings:
+        return self._settings.get(chat_id, self.default)
+    
+    def load(self, documents: dict):
+        """Replace the cached settings with documents loaded from storage"""
+        self._settings = {chat_id: ChatSettings.from_document(document) for chat_id, document in documents.items()}
+    
+    async def update(self, chat_id: int, **changes) -> ChatSettings:
+        """Change a chat's settings in memory and in storage"""
+        settings = self.get(chat_id).replace(**changes)
+        with STORAGE_LATENCY.time(operation="save_settings"):
+            await storage.save_settings(chat_id, settings.to_document())
+        self._settings[chat_id] = settings
+        return settings
+
+chat_settings = ChatSettingsCache()
+
+def retention_for(chat_id: int) -> timedelta:
+    """How long snapshots from a chat are kept"""
+    days = chat_settings.get(chat_id).retention_days
+    if days is None:
+        days = CHAT_RETENTION_DAYS.get(chat_id, RETENTION_DAYS)
+    return timedelta(days=days)
+
+class MessageStorage:
+    """Message storage with a write-behind buffer over the configured backend"""
+    
+    # Snapshots waiting for the next bulk write, keyed by (chat_id, message_id)
+    _pending = {}
+    # Snapshots currently being written, still served to readers
+    _flushing = {}
+    _flush_lock = asyncio.Lock()
+    
+    @classmethod
+    async def store_message(cls, message_id: int, user_id: int, chat_id: int, snapshot: "MessageSnapshot", edit_date: datetime = None, previous: dict = None):
+        """Queue original message for the next batched write to storage, replacing the previous snapshot if given"""
         try:
-            document = {
-                "_id": message_id,
-                "text": text,
-                "user_id": user_id,
-                "chat_id": chat_id,
-                "media_type": media_type,
-                "has_media": has_media,
-                "file_id": file_id,
-                "timestamp": datetime.utcnow()
-            }
+            now = datetime.utcnow()
+            if COMPACT_SNAPSHOTS:
+                # Edit checks only need equality, so a digest and the owner are enough
+                document = {
+                    "chat_id": chat_id,
+                    "message_id": message_id,
+                    "u": user_id,
+                    "h": snapshot.digest(),
+                    "expire_at": now + retention_for(chat_id)
+                }
+            else:
+                document = {
+                    "chat_id": chat_id,
+                    "message_id": message_id,
+                    "text": snapshot.text,
+                    "user_id": user_id,
+                    "media_type": snapshot.media_type,
+                    "has_media": snapshot.has_media,
+                    "file_id": snapshot.file_id,
+                    "timestamp": now,
+                    "expire_at": now + retention_for(chat_id)
+                }
             
-            await messages_collection.replace_one(
-                {"_id": message_id}, 
-                document, 
-                upsert=True
-            )
-            logger.debug(f"Stored message {message_id} in database")
+            if edit_date is not None:
+                # Lets later reaction updates to this message be recognised without a lookup
+                document["edit_date"] = edit_date
+            
+            key = (chat_id, message_id)
+            # A repeated store replaces the snapshot rather than adding one, so only its expiry hour moves
+            previous = previous or cls.peek_message(chat_id, message_id)
+            if previous and previous.get("expire_at"):
+                chat_counters.record_restore(chat_id, previous["expire_at"], document["expire_at"])
+            else:
+                chat_counters.record_store(chat_id, document["expire_at"])
+            cls._pending[key] = document
+            message_cache.put(key, document)
+            STORED_MESSAGES.inc()
+            logger.debug(f"Buffered message {message_id} for storage")
+            
+            if len(cls._pending) >= WRITE_BATCH_SIZE:
+                await cls.flush()
             
         except Exception as e:
             logger.error(f"Error storing message in database: {e}")
     
-    @staticmethod
-    async def get_message(message_id: int):
-        """Retrieve original message from MongoDB"""
+    @classmethod
+    async def flush(cls):
+        """Write all buffered snapshots to storage in one batch"""
+        async with cls._flush_lock:
+            if not cls._pending:
+                return
+            
+            cls._flushing, cls._pending = cls._pending, {}
+            try:
+                with STORAGE_LATENCY.time(operation="write_batch"):
+                    await storage.write_batch(list(cls._flushing.values()))
+                logger.debug(f"Flushed {len(cls._flushing)} messages to database")
+            except Exception as e:
+                logger.error(f"Error flushing messages to database: {e}")
+                # Keep the failed batch for the next attempt unless the buffer is already overflowing
+                if len(cls._pending) < WRITE_BATCH_SIZE * 10:
+                    for key, document in cls._flushing.items():
+                        cls._pending.setdefault(key, document)
+            finally:
+                cls._flushing = {}
+    
+    @classmethod
+    def peek_message(cls, chat_id: int, message_id: int):
+        """Return a snapshot only if it is already in memory"""
+        key = (chat_id, message_id)
+        return message_cache.peek(key) or cls._pending.get(key) or cls._flushing.get(key)
+    
+    @classmethod
+    async def get_message(cls, chat_id: int, message_id: int):
+        """Retrieve original message from the cache, the buffer or storage"""
+        key = (chat_id, message_id)
+        document = message_cache.get(key)
+        if document:
+            return document
+        
+        document = cls._pending.get(key) or cls._flushing.get(key)
+        if document:
+            return document
+        
         try:
-            document = await messages_collection.find_one({"_id": message_id})
+            with STORAGE_LATENCY.time(operation="find"):
+                document = await storage.find(chat_id, message_id)
+            if document:
+                message_cache.put(key, document)
             return document
         except Exception as e:
             logger.error(f"Error retrieving message from database: {e}")
             return None
     
-    @staticmethod
-    async def delete_message(message_id: int):
-        """Delete message from MongoDB"""
-        try:
-            await messages_collection.delete_one({"_id": message_id})
-            logger.debug(f"Deleted message {message_id} from database")
-        except Exception as e:
-            logger.error(f"Error deleting message from database: {e}")
+    @classmethod
+    def forget(cls, chat_id: int, message_ids: list):
+        """Drop snapshots from the cache, leaving the stored copies to expire"""
+        for message_id in message_ids:
+            message_cache.pop((chat_id, message_id))
     
     @staticmethod
-    async def cleanup_old_messages():
-        """Clean up messages older than 7 days"""
+    async def purge_expired_messages() -> int:
+        """Delete expired snapshots in small batches, yielding between them"""
+        deleted = 0
         try:
-            cutoff_date = datetime.utcnow() - timedelta(days=7)
-            result = await messages_collection.delete_many({
-                "timestamp": {"$lt": cutoff_date}
-            })
-            logger.info(f"Cleaned up {result.deleted_count} old messages from database")
+            while True:
+                with STORAGE_LATENCY.time(operation="purge_expired"):
+                    purged = await storage.purge_expired(PURGE_BATCH_SIZE)
+                deleted += purged
+                
+                if purged < PURGE_BATCH_SIZE:
+                    break
+                # Spread the I/O out instead of hammering the database
+                await asyncio.sleep(0.1)
+            
+            logger.info(f"Purged {deleted} expired messages and edit records from database")
         except Exception as e:
-            logger.error(f"Error cleaning up old messages: {e}")
+            logger.error(f"Error purging expired messages: {e}")
+        return deleted
+
+class EditJournal:
+    """Append-only journal of handled edits, written in batches like the snapshots"""
+    
+    # Records waiting for the next batched insert, oldest first
+    _pending = []
+    _flush_lock = asyncio.Lock()
+    
+    @classmethod
+    async def record(cls, message: Message, original_data: dict, snapshot: "MessageSnapshot", action: str):
+        """Queue a record of what an edit changed"""
+        if not EDIT_HISTORY:
+            return
+        
+        changes = {"text": snapshot.text, "media_type": snapshot.media_type, "file_id": snapshot.file_id}
+        # Full snapshots hold the previous version, so keep both sides of what differs; digests can't be diffed
+        if "h" in original_data:
+            changes = {field: value for field, value in changes.items() if value is not None}
+            previous = {}
+        else:
+            changed = [field for field, value in changes.items() if original_data.get(field) != value]
+            # A replaced file is shown with its media type, so keep the media fields together
+            if "media_type" in changed or "file_id" in changed:
+                changed = [field for field in changes if field in changed or field != "text"]
+            changes = {field: changes[field] for field in changed}
+            previous = {field: original_data.get(field) for field in changed}
+        
+        now = datetime.utcnow()
+        cls._pending.append({
+            "chat_id": message.chat.id,
+            "message_id": message.id,
+            "user_id": message.from_user.id,
+            "name": message.from_user.first_name,
+            "action": action,
+            "changes": changes,
+            "previous": previous,
+            "edited_at": now,
+            "expire_at": now + retention_for(message.chat.id)
+        })
+        HISTORY_RECORDS.inc(action=action)
+        
+        if len(cls._pending) >= WRITE_BATCH_SIZE:
+            await cls.flush()
+    
+    @classmethod
+    async def flush(cls):
+        """Insert all queued records in one batch"""
+        async with cls._flush_lock:
+            if not cls._pending:
+                return
+            
+            records, cls._pending = cls._pending, []
+            try:
+                with STORAGE_LATENCY.time(operation="write_history"):
+                    await storage.write_history(records)
+                logger.debug(f"Flushed {len(records)} edit records to database")
+            except Exception as e:
+                logger.error(f"Error flushing edit records to database: {e}")
+                if len(cls._pending) < WRITE_BATCH_SIZE * 10:
+                    cls._pending[:0] = records
+    
+    @classmethod
+    async def get_history(cls, chat_id: int, message_id: int = None, limit: int = HISTORY_LIMIT) -> list:
+        """Newest records of a chat or one message, including ones not written yet"""
+        await cls.flush()
+        with STORAGE_LATENCY.time(operation="find_history"):
+            return await storage.find_history(chat_id, message_id, limit)
+
+class BotIdentity:
+    """Bot account details and the keyboards built from them, loaded once at startup"""
+    
+    user = None
+    add_to_group_keyboard = None
+    start_keyboard = None
+    welcome_keyboard = None
+    
+    @classmethod
+    async def load(cls, client: Client):
+        """Resolve the bot user and prebuild its keyboards"""
+        # Client.start() already fetched the bot user, so this normally needs no API call
+        cls.user = client.me or await client.get_me()
+        add_url = f"https://t.me/{cls.user.username}?startgroup=true"
+        
+        cls.add_to_group_keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("➕ ᴀᴅᴅ ᴍᴇ ᴛᴏ ʏᴏᴜʀ ɢʀᴏᴜᴘ", url=add_url)]
+        ])
+        cls.start_keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("➕ ᴀᴅᴅ ᴍᴇ ᴛᴏ ʏᴏᴜʀ ɢʀᴏᴜᴘ", url=add_url)],
+            [
+            InlineKeyboardButton("👤 ᴏᴡɴᴇʀ", user_id=OWNER_ID),
+            InlineKeyboardButton("🤝 Sᴜᴘᴘᴏʀᴛ", url="https://t.me/FearlessCheats")
+           ]
+        ])
+        cls.welcome_keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("ADD ME TO OTHER GROUPS", url=add_url)]
+        ])
+        logger.info(f"Loaded bot identity @{cls.user.username}")
+
+ADMIN_STATUSES = (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER)
+
+class AdminCache:
+    """Per-chat cache of administrator IDs, refreshed on a TTL"""
+    
+    # How long to reuse a stale or empty admin set after a failed refresh
+    RETRY_AFTER = 60
+    
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        # chat_id -> (expires_at, set of admin user IDs)
+        self._admins = {}
+        self._locks = {}
+        self._prefetching = set()
+        self._prefetch_tasks = set()
+    
+    def peek(self, chat_id: int):
+        """Return the cached admin set without refreshing it, or None"""
+        entry = self._admins.get(chat_id)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+    
+    async def get(self, chat_id: int) -> set:
+        """Return the admin set for a chat, fetching it in one call when stale"""
+        admins = self.peek(chat_id)
+        if admins is not None:
+            return admins
+        
+        lock = self._locks.setdefault(chat_id, asyncio.Lock())
+        async with lock:
+            # Another handler may have refreshed the chat while we waited
+            admins = self.peek(chat_id)
+            if admins is not None:
+                return admins
+            
+            try:
+                admins = set()
+                with API_LATENCY.time(method="get_chat_members"):
+                    async for member in app.get_chat_members(chat_id, filter=ChatMembersFilter.ADMINISTRATORS):
+                        if member.user:
+                            admins.add(member.user.id)
+                self._admins[chat_id] = (time.monotonic() + self.ttl, admins)
+                logger.debug(f"Cached {len(admins)} admins for chat {chat_id}")
+            except Exception as e:
+                logger.error(f"Error fetching admins for chat {chat_id}: {e}")
+                stale = self._admins.get(chat_id)
+                admins = stale[1] if stale else set()
+                self._admins[chat_id] = (time.monotonic() + self.RETRY_AFTER, admins)
+            
+            return admins
+    
+    def prefetch(self, chat_id: int):
+        """Refresh a chat's admin set in the background if it isn't cached"""
+        if chat_id in self._prefetching or self.peek(chat_id) is not None:
+            return
+        
+        self._prefetching.add(chat_id)
+        task = asyncio.create_task(self.get(chat_id))
+        # The event loop only keeps a weak reference, so hold the task until it finishes
+        self._prefetch_tasks.add(task)
+        task.add_done_callback(self._prefetch_tasks.discard)
+        task.add_done_callback(lambda _: self._prefetching.discard(chat_id))
+    
+    def update_member(self, chat_id: int, user_id: int, is_admin: bool):
+        """Apply a role change to a cached admin set"""
+        entry = self._admins.get(chat_id)
+        if entry is None:
+            return
+        
+        if is_admin:
+            entry[1].add(user_id)
+        else:
+            entry[1].discard(user_id)
+    
+    def invalidate(self, chat_id: int):
+        """Forget the admin set for a chat so the next lookup refetches it"""
+        self._admins.pop(chat_id, None)
+    
+    def dump(self) -> dict:
+        """Unexpired admin sets as chat_id -> (seconds left, admin IDs)"""
+        now = time.monotonic()
+        return {chat_id: (expires_at - now, admins) for chat_id, (expires_at, admins) in self._admins.items() if expires_at > now}
+    
+    def restore(self, entries: dict, elapsed: float) -> int:
+        """Re-add dumped admin sets, less the time spent while the bot was down"""
+        now = time.monotonic()
+        restored = 0
+        for chat_id, (remaining, admins) in entries.items():
+            if remaining > elapsed:
+                self._admins[chat_id] = (now + remaining - elapsed, admins)
+                restored += 1
+        return restored
+
+admin_cache = AdminCache(ADMIN_CACHE_TTL)
+
+async def is_exempt(chat_id: int, user_id: int) -> bool:
+    """Whether a user's edits are left alone, as an admin or a user the chat trusts"""
+    return user_id in chat_settings.get(chat_id).exempt_users or await is_admin(chat_id, user_id)
 
 async def is_admin(chat_id: int, user_id: int) -> bool:
-    """Check if user is admin in the chat"""
-    try:
-        member = await app.get_chat_member(chat_id, user_id)
-        return member.status in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]
-    except Exception as e:
-        logger.error(f"Error checking admin status: {e}")
-        return False
-
-def get_message_content_info(message: Message) -> tuple:
-    """Get comprehensive message content information for comparison"""
-    text_content = message.text or message.caption or ""
-    
-    # Check media type and file ID
-    media_type = None
-    has_media = False
-    file_id = None
-    
-    if message.media:
-        has_media = True
-        if message.photo:
-            media_type = "photo"
-            file_id = message.photo.file_id
-        elif message.video:
-            media_type = "video"
-            file_id = message.video.file_id
-        elif message.audio:
-            media_type = "audio"
-            file_id = message.audio.file_id
-        elif message.voice:
-            media_type = "voice"
-            file_id = message.voice.file_id
-        elif message.video_note:
-            media_type = "video_note"
-            file_id = message.video_note.file_id
-        elif message.document:
-            media_type = "document"
-            file_id = message.document.file_id
-        elif message.sticker:
-            media_type = "sticker"
-            file_id = message.sticker.file_id
-        elif message.animation:
-            media_type = "animation"
-            file_id = message.animation.file_id
-        elif message.location:
-            media_type = "location"
-            # Location doesn't have file_id, use coordinates as identifier
-            file_id = f"{message.location.latitude},{message.location.longitude}"
-        elif message.venue:
-            media_type = "venue"
-            file_id = f"{message.venue.location.latitude},{message.venue.location.longitude}"
-        elif message.contact:
-            media_type = "contact"
-            file_id = f"{message.contact.phone_number}_{message.contact.first_name}"
-        elif message.poll:
-            media_type = "poll"
-            file_id = message.poll.id
+    """Check if user is admin in the chat using the cached admin set"""
+    return user_id in await admin_cache.get(chat_id)
+
+class TokenBucket:
+    """Token bucket rate limiter"""
+    
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class ChatActions:
+    """Deletions waiting to be sent for a single chat"""
+    
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        # message_id -> user who edited it, in arrival order
+        self.pending = OrderedDict()
+        self.bucket = TokenBucket(CHAT_ACTIONS_PER_MINUTE / 60, CHAT_ACTION_BURST)
+        self.task = None
+
+class ActionScheduler:
+    """Per-chat queues that batch deletions and notifications under rate limits"""
+    
+    # Telegram accepts at most 100 message IDs per delete_messages call
+    MAX_DELETE_BATCH = 100
+    MAX_FLOOD_RETRIES = 3
+    
+    def __init__(self, client: Client):
+        self.client = client
+        self._chats = {}
+    
+    def schedule_deletion(self, chat_id: int, message_id: int, user):
+        """Queue an edited message for deletion and notification"""
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = ChatActions(chat_id)
+        
+        chat.pending[message_id] = user
+        if chat.task is None or chat.task.done():
+            chat.task = asyncio.create_task(self._run(chat))
+    
+    async def drain(self):
+        """Wait for every chat queue to be sent"""
+        tasks = [chat.task for chat in self._chats.values() if chat.task and not chat.task.done()]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+    
+    async def _run(self, chat: ChatActions):
+        """Send a chat's queued actions in batches until its queue is empty"""
+        # Give a burst of edits a moment to accumulate into one batch
+        await asyncio.sleep(ACTION_BATCH_WINDOW)
+        
+        while chat.pending:
+            batch = OrderedDict()
+            while chat.pending and len(batch) < self.MAX_DELETE_BATCH:
+                message_id, user = chat.pending.popitem(last=False)
+                batch[message_id] = user
+            
+            try:
+                await self._send_batch(chat, batch)
+            except Exception as e:
+                logger.error(f"Error sending actions for chat {chat.chat_id}: {e}")
+    
+    async def _send_batch(self, chat: ChatActions, batch: OrderedDict):
+        """Delete a batch of messages with one call, then notify as the chat's settings ask"""
+        message_ids = list(batch)
+        try:
+            await self._call(chat, self.client.delete_messages, chat.chat_id, message_ids)
+            DELETED_MESSAGES.inc(len(message_ids))
+            logger.info(f"Deleted {len(message_ids)} edited messages in chat {chat.chat_id}")
+        except MessageDeleteForbidden:
+            logger.warning("Bot doesn't have permission to delete messages")
+            return
+        except ChatAdminRequired:
+            logger.warning("Bot needs admin rights to delete messages")
+            return
+        
+        settings = chat_settings.get(chat.chat_id)
+        if UPDATE_OVERFLOW_POLICY == "degrade" and updates_backed_up():
+            # Shed notification traffic until the update lanes catch up
+            NOTIFICATIONS_SUPPRESSED.inc(reason="saturated")
+        elif settings.notify == "silent":
+            NOTIFICATIONS_SUPPRESSED.inc(reason="silent")
         else:
-            media_type = "other"
+            await self._notify(chat, batch, each=settings.notify == "each")
+        
+        # The snapshots stay in storage until they expire, the journal has the edit
+        MessageStorage.forget(chat.chat_id, message_ids)
+    
+    @staticmethod
+    def _notification_line(name: str, count: int) -> str:
+        if count == 1:
+            return f"<b>{name} ᴊᴜsᴛ ᴇᴅɪᴛᴇᴅ ᴛʜᴇɪʀ ᴍᴇssᴀɢᴇ, ᴀɴᴅ ɪ ʜᴀᴠᴇ ᴅᴇʟᴇᴛᴇᴅ ɪᴛ.</b>"
+        return f"<b>{name} ᴊᴜsᴛ ᴇᴅɪᴛᴇᴅ {count} ᴍᴇssᴀɢᴇs, ᴀɴᴅ ɪ ʜᴀᴠᴇ ᴅᴇʟᴇᴛᴇᴅ ᴛʜᴇᴍ.</b>"
     
-    return text_content, media_type, has_media, file_id
+    async def _notify(self, chat: ChatActions, batch: OrderedDict, each: bool = False):
+        """Post one notification for a batch of deletions, or one per deletion"""
+        if each:
+            for user in batch.values():
+                await self._post(chat, [self._notification_line(user.first_name, 1)])
+            return
+        
+        # Count deletions per user so repeat offenders get a single line
+        edits = OrderedDict()
+        for user in batch.values():
+            name, count = edits.get(user.id, (user.first_name, 0))
+            edits[user.id] = (name, count + 1)
+        
+        await self._post(chat, [self._notification_line(name, count) for name, count in edits.values()])
+    
+    async def _post(self, chat: ChatActions, lines: list):
+        await self._call(
+            chat,
+            self.client.send_message,
+            chat_id=chat.chat_id,
+            text="\n".join(lines),
+            reply_markup=BotIdentity.add_to_group_keyboard,
+            parse_mode=ParseMode.HTML
+        )
+        NOTIFICATIONS_SENT.inc()
+    
+    async def _call(self, chat: ChatActions, method, *args, **kwargs):
+        """Call a Telegram method within the chat's rate limit, backing off on FloodWait"""
+        for attempt in range(self.MAX_FLOOD_RETRIES + 1):
+            await chat.bucket.acquire()
+            try:
+                with API_LATENCY.time(method=method.__name__):
+                    return await method(*args, **kwargs)
+            except FloodWait as e:
+                FLOOD_WAITS.inc(method=method.__name__)
+                if attempt == self.MAX_FLOOD_RETRIES:
+                    raise
+                logger.warning(f"FloodWait of {e.value}s in chat {chat.chat_id}, backing off")
+                await asyncio.sleep(e.value)
 
-def is_content_edited(original_data: dict, current_message: Message) -> bool:
-    """Check if the actual message content was edited (not just reactions)"""
-    current_text, current_media_type, current_has_media, current_file_id = get_message_content_info(current_message)
+action_scheduler = ActionScheduler(app)
+
+class ChatLanes:
+    """Bounded lanes that run update handlers with fixed concurrency, keeping each chat's updates in order"""
+    
+    OVERFLOW_POLICIES = ("block", "drop_edits", "degrade")
+    
+    def __init__(self, lanes: int, queue_size: int, overflow_policy: str):
+        if overflow_policy not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown UPDATE_OVERFLOW_POLICY {overflow_policy!r}, use one of: {', '.join(self.OVERFLOW_POLICIES)}")
+        self.lanes = lanes
+        self.lane_size = max(1, queue_size // lanes)
+        self.overflow_policy = overflow_policy
+        self._queues = None
+        self._tasks = []
+        self.closed = False
+    
+    def _start(self):
+        self._queues = [asyncio.Queue(self.lane_size) for _ in range(self.lanes)]
+        self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
     
-    # Compare text content
-    text_changed = original_data["text"] != current_text
+    @property
+    def depth(self) -> int:
+        """Updates waiting across all lanes"""
+        return sum(queue.qsize() for queue in self._queues or ())
     
-    # Compare media information
-    media_changed = (
-        original_data.get("media_type") != current_media_type or
-        original_data.get("has_media", False) != current_has_media
+    @property
+    def saturated(self) -> bool:
+        """Whether any lane is at its limit"""
+        return any(queue.full() for queue in self._queues or ())
+    
+    async def submit(self, chat_id: int, handler, *args, edit: bool = False):
+        """Queue a handler call on the chat's lane, shedding or waiting when it is backed up"""
+        if self.closed:
+            # The lane workers are gone, queueing would only lose the update silently
+            logger.warning(f"Dropping {handler.__name__} update for chat {chat_id} during shutdown")
+            UPDATES_DROPPED.inc(reason="shutdown")
+            return
+        if self._queues is None:
+            self._start()
+        queue = self._queues[chat_id % self.lanes]
+        
+        if edit:
+            message = args[-1]
+            # Edits without an edit date are reaction or other non-content updates, shed them first
+            if message.edit_date is None and queue.qsize() >= self.lane_size // 2:
+                UPDATES_DROPPED.inc(reason="reaction_only")
+                return
+            if queue.full() and self.overflow_policy == "drop_edits":
+                UPDATES_DROPPED.inc(reason="edit_overflow")
+                return
+        
+        # Waiting here holds up the dispatcher, which is the backpressure we want
+        await queue.put((handler, args))
+    
+    async def drain(self):
+        """Wait until every queued handler has run"""
+        for queue in self._queues or ():
+            await queue.join()
+    
+    async def stop(self, timeout: float = None):
+        """Stop taking updates, run everything already queued (for up to timeout seconds), then stop the lane workers"""
+        self.closed = True
+        try:
+            await asyncio.wait_for(self.drain(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Lanes not drained after {timeout:g}s, dropping {self.depth} queued updates")
+            UPDATES_DROPPED.inc(self.depth, reason="shutdown")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+    
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            handler, args = await queue.get()
+            try:
+                with HANDLER_LATENCY.time(handler=handler.__name__):
+                    await handler(*args)
+            except Exception as e:
+                logger.error(f"Error in {handler.__name__}: {e}")
+            finally:
+                queue.task_done()
+
+chat_lanes = ChatLanes(UPDATE_LANES, UPDATE_QUEUE_SIZE, UPDATE_OVERFLOW_POLICY)
+
+# Raw edited-message updates, shed on arrival while the dispatcher is backed up
+EDIT_UPDATES = (UpdateEditMessage, UpdateEditChannelMessage)
+
+def dispatch_backlog(client: Client = app) -> int:
+    """Updates received but not yet dispatched, which pile up while a full lane holds up the dispatcher"""
+    return client.dispatcher.updates_queue.qsize()
+
+def updates_backed_up() -> bool:
+    """Whether a lane is full or the dispatcher queue is past UPDATE_QUEUE_SIZE"""
+    return chat_lanes.saturated or dispatch_backlog() >= UPDATE_QUEUE_SIZE
+
+Gauge("editguard_update_queue_depth", "Updates waiting on the handler lanes or the dispatcher", function=lambda: chat_lanes.depth + dispatch_backlog())
+Gauge("editguard_update_queue_saturated", "1 while any handler lane or the dispatcher queue is full", function=lambda: int(updates_backed_up()))
+
+def in_chat_lane(handler=None, *, edits: bool = False):
+    """Run a pyrogram handler on its chat's lane instead of in the dispatcher"""
+    if handler is None:
+        return functools.partial(in_chat_lane, edits=edits)
+    
+    @functools.wraps(handler)
+    async def submit(client: Client, update):
+        await chat_lanes.submit(update.chat.id, handler, client, update, edit=edits)
+    return submit
+
+# Long-running tasks, cancelled on shutdown
+background_tasks = set()
+
+def start_background_task(coro):
+    """Run a coroutine in the background and keep a reference so it can be stopped"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def stop_background_tasks():
+    """Cancel the background tasks and wait for them to finish"""
+    tasks = list(background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+def in_background(handler):
+    """Run a slow, rarely used handler as a background task, holding up neither the dispatcher nor a chat lane"""
+    @functools.wraps(handler)
+    async def spawn(client: Client, update):
+        start_background_task(handler(client, update))
+    return spawn
+
+class MessageSnapshot:
+    """Content of a message as compared by edit checks"""
+    
+    # Plain __slots__ class rather than a dataclass so it stays Python 3.8 compatible
+    __slots__ = ("text", "media_type", "has_media", "file_id", "file_unique_id")
+    
+    def __init__(self, text: str, media_type: str = None, has_media: bool = False, file_id: str = None, file_unique_id: str = None):
+        self.text = text
+        self.media_type = media_type
+        self.has_media = has_media
+        self.file_id = file_id
+        self.file_unique_id = file_unique_id
+    
+    def __repr__(self):
+        return f"MessageSnapshot(media_type={self.media_type!r}, file_id={self.file_id!r}, text={self.text[:20]!r})"
+    
+    @classmethod
+    def from_message(cls, message: Message) -> "MessageSnapshot":
+        """Extract the comparable content of a message"""
+        text = message.text or message.caption or ""
+        if not message.media:
+            return cls(text)
+        
+        extractor = MEDIA_EXTRACTORS.get(message.media)
+        if extractor is None:
+            return cls(text, "other", True)
+        media_type, extract = extractor
+        file_id, file_unique_id = extract(message)
+        return cls(text, media_type, True, file_id, file_unique_id)
+    
+    def digest(self) -> bytes:
+        return content_digest(self.text, self.media_type, self.file_unique_id or self.file_id)
+
+def _file_ids(attribute: str):
+    """Extractor for media types that are Telegram files"""
+    def extract(message: Message) -> tuple:
+        media = getattr(message, attribute)
+        return media.file_id, media.file_unique_id
+    return extract
+
+def _location_id(message: Message) -> tuple:
+    # Locations don't have a file_id, use coordinates as identifier
+    return f"{message.location.latitude},{message.location.longitude}", None
+
+def _venue_id(message: Message) -> tuple:
+    return f"{message.venue.location.latitude},{message.venue.location.longitude}", None
+
+def _contact_id(message: Message) -> tuple:
+    return f"{message.contact.phone_number}_{message.contact.first_name}", None
+
+def _poll_id(message: Message) -> tuple:
+    return message.poll.id, None
+
+# MessageMediaType -> (stored media_type, extractor returning (file_id, file_unique_id)).
+# Identifiers match what earlier versions stored so existing snapshots still compare equal;
+# media types missing here are stored as "other".
+MEDIA_EXTRACTORS = {
+    MessageMediaType.PHOTO: ("photo", _file_ids("photo")),
+    MessageMediaType.VIDEO: ("video", _file_ids("video")),
+    MessageMediaType.AUDIO: ("audio", _file_ids("audio")),
+    MessageMediaType.VOICE: ("voice", _file_ids("voice")),
+    MessageMediaType.VIDEO_NOTE: ("video_note", _file_ids("video_note")),
+    MessageMediaType.DOCUMENT: ("document", _file_ids("document")),
+    MessageMediaType.STICKER: ("sticker", _file_ids("sticker")),
+    MessageMediaType.ANIMATION: ("animation", _file_ids("animation")),
+    MessageMediaType.LOCATION: ("location", _location_id),
+    MessageMediaType.VENUE: ("venue", _venue_id),
+    MessageMediaType.CONTACT: ("contact", _contact_id),
+    MessageMediaType.POLL: ("poll", _poll_id)
+}
+
+def content_digest(text: str, media_type: str, media_id: str) -> bytes:
+    """Fixed-size digest of message content for compact snapshots"""
+    # Hash the exact text, so compact snapshots catch the same edits full snapshots do
+    return hashlib.blake2b(
+        f"{text or ''}\x00{media_type or ''}\x00{media_id or ''}".encode(),
+        digest_size=16
+    ).digest()
+
+def is_content_edited(original_data: dict, current: MessageSnapshot) -> bool:
+    """Check if the actual message content was edited (not just reactions)"""
+    # Compact snapshots only keep a digest of the content
+    if "h" in original_data:
+        return original_data["h"] != current.digest()
+    
+    # Compare text, media type and file ID (detects photo/media replacement)
+    return (
+        original_data["text"] != current.text or
+        original_data.get("media_type") != current.media_type or
+        original_data.get("has_media", False) != current.has_media or
+        original_data.get("file_id") != current.file_id
     )
+
+def is_reaction_only_update(message: Message) -> bool:
+    """Recognise edit updates that can't carry new content without looking up the snapshot"""
+    # Telegram only sets edit_date when the content changes, so reaction updates keep the previous one
+    if message.edit_date is None:
+        LOOKUPS_AVOIDED.inc(reason="no_edit_date")
+        return True
     
-    # Compare file ID (detects photo/media replacement)
-    file_changed = original_data.get("file_id") != current_file_id
+    document = MessageStorage.peek_message(message.chat.id, message.id)
+    if document and document.get("edit_date") == message.edit_date:
+        LOOKUPS_AVOIDED.inc(reason="same_edit_date")
+        return True
+    return False
+
+def store_skip_reason(message: Message):
+    """Cheap checks for messages whose snapshot could never be used, or None to store it"""
+    if not (message.text or message.caption or message.media):
+        return "no_content"
+    if message.service:
+        return "service"
+    settings = chat_settings.get(message.chat.id)
+    if not settings.enabled or message.chat.id in DISABLED_CHATS:
+        return "disabled"
+    # Anonymous admins and linked channel posts have no user to check or notify
+    if not message.from_user:
+        return "no_sender"
+    if message.entities and message.text.startswith("/") and any(
+        entity.type == MessageEntityType.BOT_COMMAND and entity.offset == 0 for entity in message.entities
+    ):
+        return "command"
+    if message.from_user.id in settings.exempt_users:
+        return "exempt"
     
-    # Return True if text, media, or file content changed
-    return text_changed or media_changed or file_changed
+    # Admin edits are never deleted, so their snapshots are only needed if the admin set is unknown
+    admins = admin_cache.peek(message.chat.id)
+    if admins is None:
+        admin_cache.prefetch(message.chat.id)
+    elif message.from_user.id in admins:
+        return "admin"
+    return None
+
+@app.on_raw_update(group=-1000)
+async def shed_backlogged_edits(client: Client, update, users: dict, chats: dict):
+    """Drop edits before any handler sees them while the dispatcher queue is past UPDATE_QUEUE_SIZE"""
+    # Waiting on a full lane stalls the dispatcher, so without this its queue would grow without limit
+    if isinstance(update, EDIT_UPDATES) and dispatch_backlog(client) >= UPDATE_QUEUE_SIZE:
+        UPDATES_DROPPED.inc(reason="dispatch_backlog")
+        raise StopPropagation
 
 @app.on_message(filters.group)
+@in_chat_lane
 async def store_original_message(client: Client, message: Message):
     """Store original messages to track edits"""
     try:
-        # Store messages that have text, caption, or media
-        if message.text or message.caption or message.media:
-            text_content, media_type, has_media, file_id = get_message_content_info(message)
-            
-            await MessageStorage.store_message(
-                message_id=message.id,
-                text=text_content,
-                user_id=message.from_user.id,
-                chat_id=message.chat.id,
-                media_type=media_type,
-                has_media=has_media,
-                file_id=file_id
-            )
-                
+        skip_reason = store_skip_reason(message)
+        if skip_reason:
+            STORE_SKIPS.inc(reason=skip_reason)
+            return
+        
+        chat_counters.set_title(message.chat.id, message.chat.title)
+        
+        await MessageStorage.store_message(
+            message_id=message.id,
+            user_id=message.from_user.id,
+            chat_id=message.chat.id,
+            snapshot=MessageSnapshot.from_message(message)
+        )
+        
     except Exception as e:
         logger.error(f"Error storing message: {e}")
 
 @app.on_edited_message(filters.group)
+@in_chat_lane(edits=True)
 async def handle_edited_message(client: Client, message: Message):
     """Handle edited messages - delete them and send notification (skip admins and reactions)"""
     try:
+        if not message.from_user or message.chat.id in DISABLED_CHATS or not chat_settings.get(message.chat.id).enabled:
+            return
+        
+        if is_reaction_only_update(message):
+            logger.debug(f"Skipping message {message.id} - update has no new edit date")
+            EDIT_OUTCOMES.inc(outcome="reaction_only")
+            return
+        
         # Get the original message from database
-        original_data = await MessageStorage.get_message(message.id)
+        original_data = await MessageStorage.get_message(message.chat.id, message.id)
         
         if original_data:
             # Check if this is just a reaction update (content hasn't changed)
-            if not is_content_edited(original_data, message):
+            snapshot = MessageSnapshot.from_message(message)
+            if not is_content_edited(original_data, snapshot):
                 logger.debug(f"Skipping deletion - message {message.id} only has reaction changes")
+                EDIT_OUTCOMES.inc(outcome="reaction_only")
                 return
             
-            # Check if the user is an admin - if yes, skip deletion
-            if await is_admin(message.chat.id, message.from_user.id):
-                logger.info(f"Skipping deletion - {message.from_user.first_name} is an admin")
+            # Check if the user is an admin or exempt - if yes, skip deletion
+            if await is_exempt(message.chat.id, message.from_user.id):
+                logger.info(f"Skipping deletion - {message.from_user.first_name} is an admin or exempt")
+                EDIT_OUTCOMES.inc(outcome="admin")
+                await EditJournal.record(message, original_data, snapshot, "kept")
                 # Update the stored message with new content but don't delete
-                current_text, current_media_type, current_has_media, current_file_id = get_message_content_info(message)
                 await MessageStorage.store_message(
                     message_id=message.id,
-                    text=current_text,
                     user_id=message.from_user.id,
                     chat_id=message.chat.id,
-                    media_type=current_media_type,
-                    has_media=current_has_media,
-                    file_id=current_file_id
+                    snapshot=snapshot,
+                    edit_date=message.edit_date,
+                    previous=original_data
                 )
                 return
             
-            # Delete the edited message (only for non-admins)
-            try:
-                await message.delete()
-                logger.info(f"Deleted edited message from {message.from_user.first_name}")
-            except MessageDeleteForbidden:
-                logger.warning("Bot doesn't have permission to delete messages")
-                return
-            except ChatAdminRequired:
-                logger.warning("Bot needs admin rights to delete messages")
-                return
-            
-            # Create inline keyboard with "Add me to your group" button
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton(
-                    "➕ ᴀᴅᴅ ᴍᴇ ᴛᴏ ʏᴏᴜʀ ɢʀᴏᴜᴘ", 
-                    url=f"https://t.me/{(await client.get_me()).username}?startgroup=true"
-                )]
-            ])
-            
-            # Send notification message
-            notification_text = f"<b>{message.from_user.first_name} ᴊᴜsᴛ ᴇᴅɪᴛᴇᴅ ᴛʜᴇɪʀ ᴍᴇssᴀɢᴇ, ᴀɴᴅ ɪ ʜᴀᴠᴇ ᴅᴇʟᴇᴛᴇᴅ ɪᴛ.</b>"
-            
-            await client.send_message(
-                chat_id=message.chat.id,
-                text=notification_text,
-                reply_markup=keyboard,
-                parse_mode=ParseMode.HTML
-            )
-            
-            # Remove the message from database
-            await MessageStorage.delete_message(message.id)
+            # Queue the edited message for deletion and notification (only for non-admins)
+            action_scheduler.schedule_deletion(message.chat.id, message.id, message.from_user)
+            await EditJournal.record(message, original_data, snapshot, "deleted")
+            EDIT_OUTCOMES.inc(outcome="deleted")
+            logger.debug(f"Queued deletion of edited message from {message.from_user.first_name}")
+        else:
+            EDIT_OUTCOMES.inc(outcome="untracked")
             
     except Exception as e:
         logger.error(f"Error handling edited message: {e}")
 
+@app.on_chat_member_updated(filters.group)
+@in_chat_lane
+async def track_admin_changes(client: Client, update: ChatMemberUpdated):
+    """Keep the cached admin sets in sync with promotions and demotions"""
+    try:
+        member = update.new_chat_member or update.old_chat_member
+        if not member or not member.user:
+            admin_cache.invalidate(update.chat.id)
+            return
+        
+        is_now_admin = bool(update.new_chat_member and update.new_chat_member.status in ADMIN_STATUSES)
+        admin_cache.update_member(update.chat.id, member.user.id, is_now_admin)
+        
+    except Exception as e:
+        logger.error(f"Error tracking admin changes: {e}")
+        admin_cache.invalidate(update.chat.id)
+
 @app.on_message(filters.command("start"))
+@in_chat_lane
 async def start_command(client: Client, message: Message):
     """Handle /start command"""
     try:
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton(
-                "➕ ᴀᴅᴅ ᴍᴇ ᴛᴏ ʏᴏᴜʀ ɢʀᴏᴜᴘ", 
-                url=f"https://t.me/{(await client.get_me()).username}?startgroup=true"
-            )],
-            [
-            InlineKeyboardButton("👤 ᴏᴡɴᴇʀ", user_id=6878311635),
-            InlineKeyboardButton("🤝 Sᴜᴘᴘᴏʀᴛ", url="https://t.me/FearlessCheats")
-           ]
-        ])
-        
-        bot_info = await client.get_me()
+        bot_info = BotIdentity.user
         user_mention = f"<a href='tg://user?id={message.from_user.id}'>{message.from_user.first_name}</a>"
         bot_mention = f"<a href='tg://user?id={bot_info.id}'>{bot_info.first_name}</a>"
         
@@ -285,7 +1220,7 @@ async def start_command(client: Client, message: Message):
         
         await message.reply_text(
             welcome_text,
-            reply_markup=keyboard,
+            reply_markup=BotIdentity.start_keyboard,
             disable_web_page_preview=True,
             parse_mode=ParseMode.HTML
         )
@@ -293,21 +1228,23 @@ async def start_command(client: Client, message: Message):
     except Exception as e:
         logger.error(f"Error in start command: {e}")
 
-@app.on_message(filters.command("status") & filters.group)
+# Group commands and service messages run before store_original_message, which would otherwise take every group message
+@app.on_message(filters.command("status") & filters.group, group=-1)
+@in_chat_lane
 async def status_command(client: Client, message: Message):
     """Check bot status in group"""
     try:
-        bot_member = await client.get_chat_member(message.chat.id, (await client.get_me()).id)
+        bot_member = await client.get_chat_member(message.chat.id, BotIdentity.user.id)
         
         # Check database connection
         try:
-            await client.admin.command('ping')
+            await storage.ping()
             db_status = "✅ Connected"
         except:
             db_status = "❌ Disconnected"
         
-        # Get message count in database for this chat
-        message_count = await messages_collection.count_documents({"chat_id": message.chat.id})
+        # Get message count for this chat from the maintained counters
+        message_count = chat_counters.count(message.chat.id)
         
         if bot_member.privileges and bot_member.privileges.can_delete_messages:
             status_text = f"""✅ **Bot is working properly!**
@@ -332,22 +1269,174 @@ Please make me admin with delete messages permission."""
         logger.error(f"Error checking status: {e}")
         await message.reply_text("❌ Error checking bot status.")
 
+@app.on_message(filters.command("history") & filters.group, group=-1)
+@in_chat_lane
+async def history_command(client: Client, message: Message):
+    """Show recent edits in the chat, or of the replied-to message (admins only)"""
+    try:
+        if not message.from_user or not await is_admin(message.chat.id, message.from_user.id):
+            await message.reply_text("❌ This command is only for group admins.")
+            return
+        
+        message_id = None
+        if message.reply_to_message:
+            message_id = message.reply_to_message.id
+        elif len(message.command) > 1 and message.command[1].isdigit():
+            message_id = int(message.command[1])
+        
+        records = await EditJournal.get_history(message.chat.id, message_id)
+        if not records:
+            await message.reply_text("📭 No edits recorded" + (f" for message {message_id}." if message_id else " in this chat."))
+            return
+        
+        lines = [f"📝 <b>Edit history{f' of message {message_id}' if message_id else ''}</b>"]
+        if message_id:
+            original_data = await MessageStorage.get_message(message.chat.id, message_id)
+            if original_data and "text" in original_data:
+                lines.append(f"📄 <b>Stored version:</b> {html.escape(original_data['text'][:200])}")
+        
+        for record in records:
+            action = "🗑️ deleted" if record["action"] == "deleted" else "✏️ kept"
+            lines.append(
+                f"\n🕒 <code>{record['edited_at']:%Y-%m-%d %H:%M:%S}</code> UTC · "
+                f"message {record['message_id']} · {html.escape(record.get('name') or str(record['user_id']))} · {action}"
+            )
+            changes = record["changes"]
+            previous = record.get("previous") or {}
+            if previous.get("text") is not None:
+                lines.append(f"↩️ {html.escape(previous['text'][:200])}")
+            if changes.get("text") is not None:
+                lines.append(f"💬 {html.escape(changes['text'][:200])}")
+            if "media_type" in changes or "file_id" in changes:
+                before = f"{previous.get('media_type') or 'no media'} → " if previous else ""
+                lines.append(f"📎 {before}{changes.get('media_type') or 'media removed'}")
+        
+        await message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+        
+    except Exception as e:
+        logger.error(f"Error in history command: {e}")
+        await message.reply_text("❌ Error retrieving edit history.")
+
+def describe_settings(chat_id: int) -> str:
+    settings = chat_settings.get(chat_id)
+    exempt = ", ".join(f"<code>{user_id}</code>" for user_id in sorted(settings.exempt_users)) or "none"
+    return (
+        f"⚙️ <b>Chat settings</b>\n\n"
+        f"🛡️ <b>Edit guard:</b> {'on' if settings.enabled else 'off'}\n"
+        f"🗓️ <b>Retention:</b> {retention_for(chat_id).total_seconds() / 86400:g} days"
+        f"{'' if settings.retention_days is not None else ' (default)'}\n"
+        f"🔔 <b>Notifications:</b> {settings.notify}\n"
+        f"🤝 <b>Exempt users:</b> {exempt}\n\n"
+        f"Change with <code>/settings retention &lt;days|default&gt;</code>, "
+        f"<code>/settings notify &lt;each|batched|silent&gt;</code>, "
+        f"<code>/settings guard &lt;on|off&gt;</code>, <code>/exempt</code> and <code>/unexempt</code>."
+    )
+
+@app.on_message(filters.command("settings") & filters.group, group=-1)
+@in_chat_lane
+async def settings_command(client: Client, message: Message):
+    """Show or change the chat's settings (admins only)"""
+    try:
+        if not message.from_user or not await is_admin(message.chat.id, message.from_user.id):
+            await message.reply_text("❌ This command is only for group admins.")
+            return
+        
+        chat_id = message.chat.id
+        args = [arg.lower() for arg in message.command[1:]]
+        if not args:
+            await message.reply_text(describe_settings(chat_id), parse_mode=ParseMode.HTML)
+            return
+        
+        if len(args) != 2:
+            await message.reply_text("❌ Usage: /settings <retention|notify|guard> <value>")
+            return
+        
+        name, value = args
+        if name == "retention":
+            # Chats can only shorten what the operator configured, never keep data longer
+            limit = CHAT_RETENTION_DAYS.get(chat_id, RETENTION_DAYS)
+            if value == "default":
+                await chat_settings.update(chat_id, retention_days=None)
+            else:
+                try:
+                    days = float(value)
+                except ValueError:
+                    days = 0
+                if not 0 < days <= limit:
+                    await message.reply_text(f"❌ Retention must be a number of days between 0 and {limit:g}.")
+                    return
+                await chat_settings.update(chat_id, retention_days=days)
+        elif name == "notify":
+            if value not in NOTIFY_MODES:
+                await message.reply_text(f"❌ Notification mode must be one of: {', '.join(NOTIFY_MODES)}.")
+                return
+            await chat_settings.update(chat_id, notify=value)
+        elif name == "guard":
+            if value not in ("on", "off"):
+                await message.reply_text("❌ Use /settings guard on or /settings guard off.")
+                return
+            await chat_settings.update(chat_id, enabled=value == "on")
+        else:
+            await message.reply_text("❌ Unknown setting. Use retention, notify or guard.")
+            return
+        
+        await message.reply_text("✅ Settings updated.\n\n" + describe_settings(chat_id), parse_mode=ParseMode.HTML)
+        
+    except Exception as e:
+        logger.error(f"Error in settings command: {e}")
+        await message.reply_text("❌ Error updating settings.")
+
+@app.on_message(filters.command(["exempt", "unexempt"]) & filters.group, group=-1)
+@in_chat_lane
+async def exempt_command(client: Client, message: Message):
+    """Exempt a user from edit deletion, or take the exemption back (admins only)"""
+    try:
+        if not message.from_user or not await is_admin(message.chat.id, message.from_user.id):
+            await message.reply_text("❌ This command is only for group admins.")
+            return
+        
+        user_id = None
+        if message.reply_to_message and message.reply_to_message.from_user:
+            user_id = message.reply_to_message.from_user.id
+        elif len(message.command) > 1 and message.command[1].isdigit():
+            user_id = int(message.command[1])
+        if user_id is None:
+            await message.reply_text(f"❌ Reply to a message of the user or pass their ID: /{message.command[0]} <user_id>")
+            return
+        
+        exempt_users = set(chat_settings.get(message.chat.id).exempt_users)
+        if message.command[0] == "exempt":
+            exempt_users.add(user_id)
+            text = f"✅ Edits from <code>{user_id}</code> will no longer be deleted."
+        else:
+            exempt_users.discard(user_id)
+            text = f"✅ Edits from <code>{user_id}</code> will be deleted again."
+        await chat_settings.update(message.chat.id, exempt_users=exempt_users)
+        
+        await message.reply_text(text, parse_mode=ParseMode.HTML)
+        
+    except Exception as e:
+        logger.error(f"Error in exempt command: {e}")
+        await message.reply_text("❌ Error updating exemptions.")
+
 @app.on_message(filters.command("cleanup") & filters.private)
+@in_background
 async def cleanup_command(client: Client, message: Message):
     """Manual cleanup command (owner only)"""
     try:
-        # Check if user is the owner (replace with your user ID)
-        if message.from_user.id != 6878311635:
+        # Check if user is the owner
+        if message.from_user.id != OWNER_ID:
             await message.reply_text("❌ This command is only for the bot owner.")
             return
         
-        await MessageStorage.cleanup_old_messages()
+        purged = await MessageStorage.purge_expired_messages()
         
         # Get total message count
-        total_messages = await messages_collection.count_documents({})
+        total_messages = chat_counters.total()
         
         await message.reply_text(
             f"🧹 **Database cleanup completed!**\n\n"
+            f"🗑️ **Expired messages removed:** {purged}\n"
             f"📊 **Total messages in database:** {total_messages}",
             parse_mode=ParseMode.MARKDOWN
         )
@@ -357,41 +1446,54 @@ async def cleanup_command(client: Client, message: Message):
         await message.reply_text("❌ Error during cleanup.")
 
 @app.on_message(filters.command("stats") & filters.private)
+@in_background
 async def stats_command(client: Client, message: Message):
     """Database statistics (owner only)"""
     try:
         # Check if user is the owner
-        if message.from_user.id != 6878311635:
+        if message.from_user.id != OWNER_ID:
             await message.reply_text("❌ This command is only for the bot owner.")
             return
         
-        # Get statistics
-        total_messages = await messages_collection.count_documents({})
+        # Get statistics from the maintained counters
+        total_messages = chat_counters.total()
         
         # Get top 5 most active chats
-        pipeline = [
-            {"$group": {"_id": "$chat_id", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            {"$limit": 5}
-        ]
+        top_chats = chat_counters.top(5)
         
-        top_chats = await messages_collection.aggregate(pipeline).to_list(5)
+        if SHARDED:
+            # Chats owned by other workers are only known through their saved counters
+            others = ChatCounters()
+            others.load({chat_id: chat for chat_id, chat in (await storage.load_counters()).items() if not owns_chat(chat_id)})
+            total_messages += others.total()
+            top_chats = sorted(top_chats + others.top(5), key=lambda item: item[1], reverse=True)[:5]
+            for chat_id, title in others.titles.items():
+                chat_counters.titles.setdefault(chat_id, title)
         
         stats_text = f"""📊 **Database Statistics**
 
 📈 **Total stored messages:** {total_messages}
 
+📥 **Update queue:** {chat_lanes.depth}/{chat_lanes.lane_size * chat_lanes.lanes} on lanes, {dispatch_backlog()} waiting for dispatch, {UPDATES_DROPPED.total():g} shed
+⏭️ **Skipped snapshots:** {STORE_SKIPS.total():g}
+🪶 **Lookups avoided:** {LOOKUPS_AVOIDED.total():g}
+⚡ **Snapshot cache:** {len(message_cache)} entries, {message_cache.size_bytes / 1024 / 1024:.1f} MB
+🎯 **Cache hits/misses:** {message_cache.hits}/{message_cache.misses} ({message_cache.hit_rate:.1%})
+
 🏆 **Top 5 most active chats:**
 """
         
-        for i, chat in enumerate(top_chats, 1):
-            try:
-                chat_info = await client.get_chat(chat["_id"])
-                chat_name = chat_info.title or f"Chat {chat['_id']}"
-            except:
-                chat_name = f"Chat {chat['_id']}"
+        for i, (chat_id, count) in enumerate(top_chats, 1):
+            chat_name = chat_counters.titles.get(chat_id)
+            if not chat_name:
+                try:
+                    chat_info = await client.get_chat(chat_id)
+                    chat_name = chat_info.title or f"Chat {chat_id}"
+                    chat_counters.set_title(chat_id, chat_info.title)
+                except:
+                    chat_name = f"Chat {chat_id}"
             
-            stats_text += f"{i}. {chat_name}: {chat['count']} messages\n"
+            stats_text += f"{i}. {chat_name}: {count} messages\n"
         
         await message.reply_text(stats_text, parse_mode=ParseMode.MARKDOWN)
         
@@ -399,11 +1501,12 @@ async def stats_command(client: Client, message: Message):
         logger.error(f"Error in stats command: {e}")
         await message.reply_text("❌ Error retrieving statistics.")
 
-@app.on_message(filters.new_chat_members)
+@app.on_message(filters.new_chat_members, group=-1)
+@in_chat_lane
 async def welcome_new_member(client: Client, message: Message):
     """Welcome message when bot is added to a group"""
     try:
-        bot_user = await client.get_me()
+        bot_user = BotIdentity.user
         
         # Check if bot was added
         for new_member in message.new_chat_members:
@@ -419,40 +1522,102 @@ I'm now monitoring this group for edited messages with persistent MongoDB storag
 
 **Features:**
 ✅ Persistent storage - data survives restarts
-✅ Automatic cleanup of old messages (7 days)
+✅ Automatic cleanup of old messages ({retention_for(message.chat.id).total_seconds() / 86400:g} days)
 ✅ Real-time edit monitoring
 ✅ Ignores reaction-only changes
 
 Use /status to check if I'm configured correctly.
                 """
                 
-                keyboard = InlineKeyboardMarkup([
-                    [InlineKeyboardButton(
-                        "ADD ME TO OTHER GROUPS", 
-                        url=f"https://t.me/{bot_user.username}?startgroup=true"
-                    )]
-                ])
-                
                 await message.reply_text(
                     welcome_text,
-                    reply_markup=keyboard
+                    reply_markup=BotIdentity.welcome_keyboard
                 )
                 break
                 
     except Exception as e:
         logger.error(f"Error in welcome message: {e}")
 
+STATE_VERSION = 1
+
+def save_state(path: str):
+    """Write the hot caches to a local file so the next start is warm"""
+    state = {
+        "version": STATE_VERSION,
+        "saved_at": time.time(),
+        "messages": message_cache.dump(),
+        "admins": admin_cache.dump()
+    }
+    # Write next to the target and swap it in, so a crash never leaves a torn file
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as file:
+        pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, path)
+    logger.info(f"💾 Saved {len(state['messages'])} cached snapshots and {len(state['admins'])} admin sets to {path}")
+
+def load_state(path: str):
+    """Reload caches saved by the previous run, if the file is there and readable"""
+    try:
+        with open(path, "rb") as file:
+            state = pickle.load(file)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable state file {path}: {e}")
+        return
+    
+    if state.get("version") != STATE_VERSION:
+        logger.warning(f"Ignoring state file {path} from another version")
+        return
+    
+    elapsed = max(0.0, time.time() - state["saved_at"])
+    messages = message_cache.restore(state["messages"], elapsed)
+    admins = admin_cache.restore(state["admins"], elapsed)
+    logger.info(f"♻️ Restored {messages} cached snapshots and {admins} admin sets from {path}")
+
 # Periodic cleanup task
 async def periodic_cleanup():
-    """Run cleanup every 24 hours"""
+    """Purge expired messages every PURGE_INTERVAL seconds when no TTL index is used"""
     while True:
         try:
-            await asyncio.sleep(86400)  # 24 hours
-            await MessageStorage.cleanup_old_messages()
+            await asyncio.sleep(PURGE_INTERVAL)
+            await MessageStorage.purge_expired_messages()
             logger.info("Periodic cleanup completed")
         except Exception as e:
             logger.error(f"Error in periodic cleanup: {e}")
 
+# Periodic flush task
+async def periodic_flush():
+    """Flush buffered snapshots at least every WRITE_FLUSH_INTERVAL seconds"""
+    while True:
+        try:
+            await asyncio.sleep(WRITE_FLUSH_INTERVAL)
+            # Shielded so shutdown can't cancel a batch halfway through its write
+            await asyncio.shield(MessageStorage.flush())
+            await asyncio.shield(EditJournal.flush())
+        except Exception as e:
+            logger.error(f"Error in periodic flush: {e}")
+
+# Periodic counter persistence task
+async def periodic_counter_persist():
+    """Save changed chat counters every STATS_PERSIST_INTERVAL seconds"""
+    while True:
+        try:
+            await asyncio.sleep(STATS_PERSIST_INTERVAL)
+            await asyncio.shield(chat_counters.persist())
+        except Exception as e:
+            logger.error(f"Error in periodic counter persistence: {e}")
+
+async def load_chat_counters():
+    """Load persisted chat counters, counting stored snapshots once if there are none yet"""
+    counters = await storage.load_counters()
+    if not counters:
+        logger.info("No saved chat counters, counting stored messages once")
+        counters = await storage.rebuild_counters()
+        # Save the result straight away so the full count never runs again
+        await storage.save_counters(counters)
+    chat_counters.load({chat_id: chat for chat_id, chat in counters.items() if owns_chat(chat_id)})
+
 # Error handler
 @app.on_message(filters.all, group=-300)
 async def error_handler(client: Client, message: Message):
@@ -463,33 +1628,223 @@ async def startup():
     """Startup tasks"""
     try:
         # Test database connection
-        await client.admin.command('ping')
-        logger.info("✅ MongoDB connection successful")
+        await storage.ping()
+        logger.info(f"✅ {STORAGE_BACKEND} storage connection successful")
         
-        # Create index for better performance
-        await messages_collection.create_index([("timestamp", 1)])
-        await messages_collection.create_index([("chat_id", 1)])
+        # Migrate old documents and create indexes for better performance
+        await storage.ensure_indexes()
+        chat_settings.load({chat_id: settings for chat_id, settings in (await storage.load_settings()).items() if owns_chat(chat_id)})
+        logger.info(f"Loaded settings for {len(chat_settings)} chats")
+        await load_chat_counters()
         
-        # Start periodic cleanup task
-        asyncio.create_task(periodic_cleanup())
+        # Start periodic flush task, and cleanup when the backend isn't expiring messages itself
+        if not storage.supports_ttl and (WORKER_INDEX == 0 or STORAGE_BACKEND == "sqlite"):
+            start_background_task(periodic_cleanup())
+        start_background_task(periodic_flush())
+        start_background_task(periodic_counter_persist())
         
     except Exception as e:
         logger.error(f"❌ Database connection failed: {e}")
-        print("❌ Failed to connect to MongoDB. Please check your MONGODB_URI.")
+        print("❌ Failed to connect to storage. Please check STORAGE_BACKEND and MONGODB_URI or SQLITE_PATH.")
+    
+    if METRICS_PORT:
+        try:
+            await start_metrics_server(METRICS_HOST, METRICS_PORT + WORKER_INDEX)
+        except Exception as e:
+            logger.error(f"❌ Failed to start metrics server: {e}")
+    
+    # Warm the caches before any update arrives
+    if STATE_FILE:
+        load_state(worker_path(STATE_FILE))
+
+async def shutdown():
+    """Finish in-flight work, write out everything buffered and save the hot caches"""
+    # Stop taking updates first. A dispatcher worker blocked on a full lane is released
+    # because the lanes keep running until they are drained below.
+    await app.dispatcher.stop()
+    
+    # Finish queued updates and send queued deletions before the connection goes away, within
+    # SHUTDOWN_TIMEOUT so there is time left to write everything out before a supervisor kills us
+    deadline = asyncio.get_running_loop().time() + SHUTDOWN_TIMEOUT
+    await chat_lanes.stop(timeout=SHUTDOWN_TIMEOUT)
+    try:
+        await asyncio.wait_for(action_scheduler.drain(), max(0, deadline - asyncio.get_running_loop().time()))
+    except asyncio.TimeoutError:
+        logger.warning(f"Queued deletions not sent after {SHUTDOWN_TIMEOUT:g}s, dropping them")
+    await app.stop()
+    
+    await stop_background_tasks()
+    
+    # Write out anything still buffered before exiting
+    await MessageStorage.flush()
+    await EditJournal.flush()
+    await chat_counters.persist()
+    
+    if STATE_FILE:
+        try:
+            save_state(worker_path(STATE_FILE))
+        except Exception as e:
+            logger.error(f"Error saving state file: {e}")
+    
+    await storage.close()
+
+async def main():
+    """Run startup tasks, serve updates until stopped, then flush buffered writes"""
+    await startup()
+    
+    await app.start()
+    await BotIdentity.load(app)
+    print(f"🚀 Bot is running with persistent {STORAGE_BACKEND} storage...")
+    
+    try:
+        if SHARDED:
+            # The receiving process stops us by closing the pipe once it has stopped taking updates
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            await relay_updates()
+        else:
+            await idle()
+    finally:
+        await shutdown()
+
+# Sharded mode: one process receives every update and routes it by chat to the worker that owns it
+def raw_chat_id(update):
+    """Chat ID of a raw update in pyrogram's format, or None for updates without a chat"""
+    peer = getattr(getattr(update, "message", None), "peer_id", None) or getattr(update, "peer", None)
+    if peer is not None:
+        return utils.get_peer_id(peer)
+    if getattr(update, "channel_id", None):
+        return utils.get_channel_id(update.channel_id)
+    if getattr(update, "chat_id", None):
+        return -update.chat_id
+    return None
+
+async def relay_updates():
+    """Read routed updates from stdin and dispatch them until the receiving process closes the pipe"""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin.buffer)
+    
+    while True:
+        try:
+            size = int.from_bytes(await reader.readexactly(4), "little")
+            data = BytesIO(await reader.readexactly(size))
+        except asyncio.IncompleteReadError:
+            logger.info("Update pipe closed, shutting down")
+            return
+        
+        try:
+            update = TLObject.read(data)
+            users = {user.id: user for user in TLObject.read(data)}
+            chats = {chat.id: chat for chat in TLObject.read(data)}
+            await dispatch_update(update, users, chats)
+        except Exception as e:
+            logger.error(f"Error dispatching routed update: {e}")
 
-if __name__ == "__main__":
-    print("🤖 Starting Edit Delete Bot with MongoDB...")
+async def dispatch_update(update, users: dict, chats: dict):
+    """Parse a raw update and run the first matching handler of each group, as pyrogram's dispatcher does"""
+    # Remember access hashes so API calls about these chats and users can resolve them
+    await app.fetch_peers(list(users.values()))
+    await app.fetch_peers(list(chats.values()))
+    
+    parser = app.dispatcher.update_parsers.get(type(update))
+    if parser is None:
+        return
+    parsed_update, handler_type = await parser(update, users, chats)
+    
+    try:
+        for group in app.dispatcher.groups.values():
+            for handler in group:
+                if isinstance(handler, handler_type) and await handler.check(app, parsed_update):
+                    await handler.callback(app, parsed_update)
+                    break
+    except StopPropagation:
+        pass
+
+async def run_router():
+    """Start the workers, then receive updates and pipe each one to the worker owning its chat"""
+    workers = [
+        await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__),
+            stdin=asyncio.subprocess.PIPE,
+            env=dict(os.environ, WORKER_ID=str(worker_id))
+        )
+        for worker_id in range(WORKERS)
+    ]
+    
+    router = Client("edit_delete_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN, workers=1)
+    # Routing only needs the raw update, so skip pyrogram's parsing (and the reply lookups it makes) here
+    router.dispatcher.update_parsers = {}
+    
+    @router.on_raw_update()
+    async def route_update(client: Client, update, users: dict, chats: dict):
+        if isinstance(update, EDIT_UPDATES) and dispatch_backlog(client) >= UPDATE_QUEUE_SIZE:
+            # A worker's full pipe holds up the router's dispatcher, so shed edits here as a single process would
+            UPDATES_DROPPED.inc(reason="dispatch_backlog")
+            return
+        chat_id = raw_chat_id(update)
+        worker = workers[shard_for(chat_id, WORKERS) if chat_id is not None else 0]
+        payload = update.write() + Vector(list(users.values())) + Vector(list(chats.values()))
+        try:
+            worker.stdin.write(len(payload).to_bytes(4, "little") + payload)
+            # Waits while the worker's pipe is full, which holds back the router's single dispatcher
+            await worker.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            logger.error(f"Worker {workers.index(worker)} is gone, dropping update for chat {chat_id}")
+    
+    await router.start()
+    print(f"🚀 Routing updates to {WORKERS} workers...")
+    
+    # Run until stopped, or until a worker exits on its own and leaves its chats unmoderated
+    stop_signal = asyncio.create_task(idle())
+    exits = [asyncio.create_task(worker.wait()) for worker in workers]
+    await asyncio.wait([stop_signal, *exits], return_when=asyncio.FIRST_COMPLETED)
+    failed = [worker_id for worker_id, exited in enumerate(exits) if exited.done()]
+    stop_signal.cancel()
+    
+    # Stop receiving first, then let each worker finish what it was sent
+    await router.stop()
+    for worker in workers:
+        worker.stdin.close()
+    await asyncio.gather(*exits)
+    return failed
+
+def check_worker_count():
+    """Refuse to start when WORKERS changed since the SQLite data was split between worker files"""
+    if STORAGE_BACKEND != "sqlite" or SQLITE_PATH == ":memory:":
+        return
+    # Chats that hash to a different worker would silently lose their settings, history and snapshots
+    marker = f"{SQLITE_PATH}.workers"
+    if os.path.exists(marker):
+        with open(marker) as f:
+            previous = int(f.read())
+        if previous != WORKERS:
+            print(f"❌ {SQLITE_PATH} was split between {previous} workers, WORKERS={WORKERS} would move chats away from their data. Restore WORKERS={previous}, or delete {marker} to start over.")
+            sys.exit(1)
+    else:
+        with open(marker, "w") as f:
+            f.write(str(WORKERS))
+
+if __name__ == "__main__" and WORKERS > 1 and WORKER_ID is None:
+    check_worker_count()
+    print(f"🤖 Starting Edit Delete Bot with {WORKERS} workers...")
+    failed = asyncio.get_event_loop().run_until_complete(run_router())
+    if failed:
+        # Exit non-zero so the process supervisor restarts the whole set
+        print(f"❌ Worker {', '.join(map(str, failed))} exited unexpectedly, stopping")
+        sys.exit(1)
+
+elif __name__ == "__main__":
+    if not SHARDED:
+        check_worker_count()
+    print(f"🤖 Starting Edit Delete Bot{f' worker {WORKER_ID}' if SHARDED else ''}...")
     print("📝 Make sure to:")
     print("   1. Replace API_ID, API_HASH, BOT_TOKEN, and MONGODB_URI in config.py")
     print("   2. Install required packages:")
     print("      pip install pyrogram motor")
     print("   3. Make the bot admin in groups with delete messages permission")
     print("   4. Admins can edit messages without deletion")
-    print("   5. Database automatically cleans up messages older than 7 days")
+    print(f"   5. Database automatically cleans up messages older than {RETENTION_DAYS:g} days")
     print("   6. Reactions won't trigger message deletion")
-    print("🚀 Bot is running with persistent MongoDB storage...")
-    
-    # Run startup tasks
-    asyncio.get_event_loop().run_until_complete(startup())
     
-    app.run()
+    app.run(main())
@@ -0,0 +1,510 @@
+import asyncio
+import json
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+
+class StorageBackend:
+    """Interface for persisting message snapshots"""
+
+    # Whether the backend expires documents by itself (no periodic purge needed)
+    supports_ttl = False
+
+    async def ping(self):
+        """Raise if the backend can't be reached"""
+        raise NotImplementedError
+
+    async def ensure_indexes(self):
+        """Run migrations and create the lookup and expiry indexes"""
+        raise NotImplementedError
+
+    async def write_batch(self, documents: list):
+        """Upsert snapshots keyed by (chat_id, message_id) in one batch"""
+        raise NotImplementedError
+
+    async def find(self, chat_id: int, message_id: int):
+        """Return the snapshot for a message, or None"""
+        raise NotImplementedError
+
+    async def purge_expired(self, batch_size: int) -> int:
+        """Delete up to batch_size expired snapshots and edit records and return how many were removed"""
+        raise NotImplementedError
+
+    async def write_history(self, records: list):
+        """Append edit records in one batch"""
+        raise NotImplementedError
+
+    async def find_history(self, chat_id: int, message_id: int = None, limit: int = 10) -> list:
+        """Newest edit records of a chat, or of one message, newest first"""
+        raise NotImplementedError
+
+    async def load_counters(self) -> dict:
+        """Persisted per-chat counters as chat_id -> {"title": str, "buckets": {expiry hour: count}}"""
+        raise NotImplementedError
+
+    async def save_counters(self, counters: dict):
+        """Persist per-chat counters in the format returned by load_counters"""
+        raise NotImplementedError
+
+    async def rebuild_counters(self) -> dict:
+        """Count stored snapshots per chat and expiry hour with one full scan"""
+        raise NotImplementedError
+
+    async def load_settings(self) -> dict:
+        """Every chat's saved settings as chat_id -> settings document"""
+        raise NotImplementedError
+
+    async def save_settings(self, chat_id: int, settings: dict):
+        """Replace one chat's saved settings"""
+        raise NotImplementedError
+
+    async def close(self):
+        """Release connections"""
+
+class MongoBackend(StorageBackend):
+    """MongoDB storage using motor"""
+
+    # Bumped whenever ensure_indexes gains a data migration
+    SCHEMA_VERSION = 1
+
+    def __init__(self, uri: str, default_retention: timedelta, use_ttl_index: bool = True):
+        # Imported here so embedded deployments don't need motor installed
+        import motor.motor_asyncio
+
+        self.client = motor.motor_asyncio.AsyncIOMotorClient(uri)
+        self.db = self.client.editguard_bot
+        self.messages = self.db.messages
+        self.stats = self.db.stats
+        self.history = self.db.history
+        self.settings = self.db.settings
+        self.meta = self.db.meta
+        self.default_retention = default_retention
+        self.supports_ttl = use_ttl_index
+
+    async def ping(self):
+        await self.client.admin.command('ping')
+
+    async def ensure_indexes(self):
+        from pymongo.errors import OperationFailure
+
+        # The migrations scan the whole collection, so they only run until the marker says they're done
+        marker = await self.meta.find_one({"_id": "schema"})
+        if (marker or {}).get("version", 0) < self.SCHEMA_VERSION:
+            await self._migrate()
+            await self.meta.update_one({"_id": "schema"}, {"$set": {"version": self.SCHEMA_VERSION}}, upsert=True)
+
+        await self.messages.create_index(
+            [("chat_id", 1), ("message_id", 1)],
+            name="chat_message",
+            unique=True
+        )
+
+        # expire_at holds each snapshot's own deadline, so per-chat retention works with one TTL index
+        expiry_options = {"expireAfterSeconds": 0} if self.supports_ttl else {}
+        for collection in (self.messages, self.history):
+            try:
+                await collection.create_index([("expire_at", 1)], name="expire_at", **expiry_options)
+            except OperationFailure:
+                # USE_TTL_INDEX changed since the index was built, so rebuild it with the new options
+                await collection.drop_index("expire_at")
+                await collection.create_index([("expire_at", 1)], name="expire_at", **expiry_options)
+
+        await self.history.create_index(
+            [("chat_id", 1), ("message_id", 1), ("edited_at", -1)],
+            name="chat_message_edited"
+        )
+        await self.history.create_index([("chat_id", 1), ("edited_at", -1)], name="chat_edited")
+
+    async def _migrate(self):
+        from pymongo.errors import OperationFailure
+
+        # Older documents used the message ID as _id and had no message_id field
+        result = await self.messages.update_many(
+            {"message_id": {"$exists": False}},
+            [{"$set": {"message_id": "$_id"}}]
+        )
+        if result.modified_count:
+            logger.info(f"Migrated {result.modified_count} messages to (chat_id, message_id) keys")
+
+        # Documents from before per-document expiry get the default retention
+        result = await self.messages.update_many(
+            {"expire_at": {"$exists": False}},
+            [{"$set": {"expire_at": {"$add": ["$timestamp", int(self.default_retention.total_seconds() * 1000)]}}}]
+        )
+        if result.modified_count:
+            logger.info(f"Set expiry on {result.modified_count} older messages")
+
+        # The compound index serves every per-chat query and expiry replaces the timestamp index
+        for index_name in ("chat_id_1", "timestamp_1"):
+            try:
+                await self.messages.drop_index(index_name)
+            except OperationFailure:
+                pass
+
+    async def write_batch(self, documents: list):
+        from pymongo import ReplaceOne
+
+        await self.messages.bulk_write(
+            [
+                ReplaceOne({"chat_id": document["chat_id"], "message_id": document["message_id"]}, document, upsert=True)
+                for document in documents
+            ],
+            ordered=False
+        )
+
+    async def find(self, chat_id: int, message_id: int):
+        return await self.messages.find_one(
+            {"chat_id": chat_id, "message_id": message_id},
+            {"_id": 0}
+        )
+
+    async def purge_expired(self, batch_size: int) -> int:
+        deleted = 0
+        for collection in (self.messages, self.history):
+            cursor = collection.find(
+                {"expire_at": {"$lt": datetime.utcnow()}},
+                {"_id": 1}
+            ).limit(batch_size)
+            ids = [document["_id"] async for document in cursor]
+            if ids:
+                result = await collection.delete_many({"_id": {"$in": ids}})
+                deleted += result.deleted_count
+        return deleted
+
+    async def write_history(self, records: list):
+        # insert_many adds _id to the documents it is given, so pass copies
+        await self.history.insert_many([dict(record) for record in records], ordered=False)
+
+    async def find_history(self, chat_id: int, message_id: int = None, limit: int = 10) -> list:
+        query = {"chat_id": chat_id} if message_id is None else {"chat_id": chat_id, "message_id": message_id}
+        cursor = self.history.find(query, {"_id": 0}).sort("edited_at", -1).limit(limit)
+        return await cursor.to_list(limit)
+
+    async def load_counters(self) -> dict:
+        counters = {}
+        async for document in self.stats.find({}):
+            counters[document["_id"]] = {
+                "title": document.get("title"),
+                "buckets": {int(hour): count for hour, count in document.get("buckets", {}).items()}
+            }
+        return counters
+
+    async def save_counters(self, counters: dict):
+        from pymongo import ReplaceOne
+
+        if not counters:
+            return
+        await self.stats.bulk_write(
+            [
+                ReplaceOne(
+                    {"_id": chat_id},
+                    {"title": chat["title"], "buckets": {str(hour): count for hour, count in chat["buckets"].items()}},
+                    upsert=True
+                )
+                for chat_id, chat in counters.items()
+            ],
+            ordered=False
+        )
+
+    async def rebuild_counters(self) -> dict:
+        pipeline = [
+            {"$group": {
+                "_id": {
+                    "chat_id": "$chat_id",
+                    "hour": {"$floor": {"$divide": [{"$toLong": "$expire_at"}, 3600000]}}
+                },
+                "count": {"$sum": 1}
+            }}
+        ]
+        counters = {}
+        async for group in self.messages.aggregate(pipeline):
+            chat = counters.setdefault(group["_id"]["chat_id"], {"title": None, "buckets": {}})
+            chat["buckets"][int(group["_id"]["hour"])] = group["count"]
+        return counters
+
+    async def load_settings(self) -> dict:
+        settings = {}
+        async for document in self.settings.find({}):
+            settings[document.pop("_id")] = document
+        return settings
+
+    async def save_settings(self, chat_id: int, settings: dict):
+        await self.settings.replace_one({"_id": chat_id}, settings, upsert=True)
+
+    async def close(self):
+        self.client.close()
+
+class SQLiteBackend(StorageBackend):
+    """Embedded SQLite storage in WAL mode for single-node deployments"""
+
+    COLUMNS = "chat_id, message_id, user_id, text, media_type, has_media, file_id, digest, timestamp, expire_at"
+
+    def __init__(self, path: str):
+        self.path = path
+        # sqlite3 connections are not thread-safe, so every query runs on one worker thread
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._db = None
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.path)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+        return self._db
+
+    @staticmethod
+    def _to_seconds(value: datetime):
+        return (value - EPOCH).total_seconds() if value else None
+
+    @staticmethod
+    def _to_datetime(value: float):
+        return EPOCH + timedelta(seconds=value) if value is not None else None
+
+    @classmethod
+    def _to_row(cls, document: dict) -> tuple:
+        return (
+            document["chat_id"],
+            document["message_id"],
+            document.get("user_id", document.get("u")),
+            document.get("text"),
+            document.get("media_type"),
+            int(document.get("has_media", False)),
+            document.get("file_id"),
+            document.get("h"),
+            cls._to_seconds(document.get("timestamp")),
+            cls._to_seconds(document["expire_at"])
+        )
+
+    @classmethod
+    def _to_document(cls, row: tuple) -> dict:
+        chat_id, message_id, user_id, text, media_type, has_media, file_id, digest, timestamp, expire_at = row
+        if digest is not None:
+            return {
+                "chat_id": chat_id,
+                "message_id": message_id,
+                "u": user_id,
+                "h": digest,
+                "expire_at": cls._to_datetime(expire_at)
+            }
+        return {
+            "chat_id": chat_id,
+            "message_id": message_id,
+            "text": text,
+            "user_id": user_id,
+            "media_type": media_type,
+            "has_media": bool(has_media),
+            "file_id": file_id,
+            "timestamp": cls._to_datetime(timestamp),
+            "expire_at": cls._to_datetime(expire_at)
+        }
+
+    async def ping(self):
+        await self._run(lambda: self._connection().execute("SELECT 1").fetchone())
+
+    async def ensure_indexes(self):
+        def create():
+            db = self._connection()
+            with db:
+                db.execute("""
+                    CREATE TABLE IF NOT EXISTS messages (
+                        chat_id INTEGER NOT NULL,
+                        message_id INTEGER NOT NULL,
+                        user_id INTEGER,
+                        text TEXT,
+                        media_type TEXT,
+                        has_media INTEGER NOT NULL DEFAULT 0,
+                        file_id TEXT,
+                        digest BLOB,
+                        timestamp REAL,
+                        expire_at REAL NOT NULL,
+                        PRIMARY KEY (chat_id, message_id)
+                    ) WITHOUT ROWID
+                """)
+                db.execute("CREATE INDEX IF NOT EXISTS messages_expire_at ON messages (expire_at)")
+                db.execute("""
+                    CREATE TABLE IF NOT EXISTS history (
+                        chat_id INTEGER NOT NULL,
+                        message_id INTEGER NOT NULL,
+                        user_id INTEGER,
+                        name TEXT,
+                        action TEXT NOT NULL,
+                        changes TEXT NOT NULL,
+                        previous TEXT,
+                        edited_at REAL NOT NULL,
+                        expire_at REAL NOT NULL
+                    )
+                """)
+                # Journals created before previous values were recorded lack the column
+                if "previous" not in [column[1] for column in db.execute("PRAGMA table_info(history)")]:
+                    db.execute("ALTER TABLE history ADD COLUMN previous TEXT")
+                db.execute("CREATE INDEX IF NOT EXISTS history_chat_message ON history (chat_id, message_id, edited_at)")
+                db.execute("CREATE INDEX IF NOT EXISTS history_chat_edited ON history (chat_id, edited_at)")
+                db.execute("CREATE INDEX IF NOT EXISTS history_expire_at ON history (expire_at)")
+                db.execute("""
+                    CREATE TABLE IF NOT EXISTS chat_stats (
+                        chat_id INTEGER PRIMARY KEY,
+                        title TEXT,
+                        buckets TEXT NOT NULL
+                    )
+                """)
+                db.execute("""
+                    CREATE TABLE IF NOT EXISTS chat_settings (
+                        chat_id INTEGER PRIMARY KEY,
+                        settings TEXT NOT NULL
+                    )
+                """)
+        await self._run(create)
+
+    async def write_batch(self, documents: list):
+        rows = [self._to_row(document) for document in documents]
+
+        def write():
+            db = self._connection()
+            with db:
+                db.executemany(f"INSERT OR REPLACE INTO messages ({self.COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        await self._run(write)
+
+    async def find(self, chat_id: int, message_id: int):
+        def select():
+            return self._connection().execute(
+                f"SELECT {self.COLUMNS} FROM messages WHERE chat_id = ? AND message_id = ?",
+                (chat_id, message_id)
+            ).fetchone()
+        row = await self._run(select)
+        return self._to_document(row) if row else None
+
+    async def purge_expired(self, batch_size: int) -> int:
+        cutoff = self._to_seconds(datetime.utcnow())
+
+        def purge():
+            db = self._connection()
+            with db:
+                deleted = db.execute(
+                    """
+                    DELETE FROM messages WHERE (chat_id, message_id) IN (
+                        SELECT chat_id, message_id FROM messages WHERE expire_at < ? LIMIT ?
+                    )
+                    """,
+                    (cutoff, batch_size)
+                ).rowcount
+                deleted += db.execute(
+                    "DELETE FROM history WHERE rowid IN (SELECT rowid FROM history WHERE expire_at < ? LIMIT ?)",
+                    (cutoff, batch_size)
+                ).rowcount
+                return deleted
+        return await self._run(purge)
+
+    async def write_history(self, records: list):
+        rows = [
+            (
+                record["chat_id"],
+                record["message_id"],
+                record["user_id"],
+                record.get("name"),
+                record["action"],
+                json.dumps(record["changes"]),
+                json.dumps(record.get("previous") or {}),
+                self._to_seconds(record["edited_at"]),
+                self._to_seconds(record["expire_at"])
+            )
+            for record in records
+        ]
+
+        def write():
+            db = self._connection()
+            with db:
+                db.executemany(
+                    "INSERT INTO history (chat_id, message_id, user_id, name, action, changes, previous, edited_at, expire_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+        await self._run(write)
+
+    async def find_history(self, chat_id: int, message_id: int = None, limit: int = 10) -> list:
+        def select():
+            columns = "chat_id, message_id, user_id, name, action, changes, previous, edited_at, expire_at"
+            if message_id is None:
+                return self._connection().execute(
+                    f"SELECT {columns} FROM history WHERE chat_id = ? ORDER BY edited_at DESC LIMIT ?",
+                    (chat_id, limit)
+                ).fetchall()
+            return self._connection().execute(
+                f"SELECT {columns} FROM history WHERE chat_id = ? AND message_id = ? ORDER BY edited_at DESC LIMIT ?",
+                (chat_id, message_id, limit)
+            ).fetchall()
+        return [
+            {
+                "chat_id": chat_id,
+                "message_id": message_id,
+                "user_id": user_id,
+                "name": name,
+                "action": action,
+                "changes": json.loads(changes),
+                "previous": json.loads(previous) if previous else {},
+                "edited_at": self._to_datetime(edited_at),
+                "expire_at": self._to_datetime(expire_at)
+            }
+            for chat_id, message_id, user_id, name, action, changes, previous, edited_at, expire_at in await self._run(select)
+        ]
+
+    async def load_counters(self) -> dict:
+        def select():
+            return self._connection().execute("SELECT chat_id, title, buckets FROM chat_stats").fetchall()
+        return {
+            chat_id: {"title": title, "buckets": {int(hour): count for hour, count in json.loads(buckets).items()}}
+            for chat_id, title, buckets in await self._run(select)
+        }
+
+    async def save_counters(self, counters: dict):
+        rows = [(chat_id, chat["title"], json.dumps(chat["buckets"])) for chat_id, chat in counters.items()]
+
+        def write():
+            db = self._connection()
+            with db:
+                db.executemany("INSERT OR REPLACE INTO chat_stats (chat_id, title, buckets) VALUES (?, ?, ?)", rows)
+        await self._run(write)
+
+    async def rebuild_counters(self) -> dict:
+        def select():
+            return self._connection().execute(
+                "SELECT chat_id, CAST(expire_at / 3600 AS INTEGER), COUNT(*) FROM messages GROUP BY 1, 2"
+            ).fetchall()
+        counters = {}
+        for chat_id, hour, count in await self._run(select):
+            counters.setdefault(chat_id, {"title": None, "buckets": {}})["buckets"][hour] = count
+        return counters
+
+    async def load_settings(self) -> dict:
+        def select():
+            return self._connection().execute("SELECT chat_id, settings FROM chat_settings").fetchall()
+        return {chat_id: json.loads(settings) for chat_id, settings in await self._run(select)}
+
+    async def save_settings(self, chat_id: int, settings: dict):
+        def write():
+            db = self._connection()
+            with db:
+                db.execute("INSERT OR REPLACE INTO chat_settings (chat_id, settings) VALUES (?, ?)", (chat_id, json.dumps(settings)))
+        await self._run(write)
+
+    async def close(self):
+        def close():
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+        await self._run(close)
+        self._executor.shutdown(wait=False)
+
+def create_backend(name: str, mongodb_uri: str, sqlite_path: str, default_retention: timedelta, use_ttl_index: bool) -> StorageBackend:
+    """Build the storage backend selected by STORAGE_BACKEND"""
+    if name == "mongo":
+        return MongoBackend(mongodb_uri, default_retention, use_ttl_index)
+    if name == "sqlite":
+        return SQLiteBackend(sqlite_path)
+    raise ValueError(f"Unknown storage backend: {name}")
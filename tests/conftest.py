@@ -0,0 +1,14 @@
+import os
+import sys
+
+# The modules live at the repository root rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The bot reads its settings at import time, so point it at harmless values first
+os.environ["API_ID"] = os.environ.get("API_ID") or "1"
+os.environ["API_HASH"] = os.environ.get("API_HASH") or "test"
+os.environ["BOT_TOKEN"] = os.environ.get("BOT_TOKEN") or "1:test"
+os.environ["STORAGE_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = ":memory:"
+os.environ["STATE_FILE"] = ""
+os.environ["METRICS_PORT"] = "0"
@@ -0,0 +1,270 @@
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("pyrogram")
+
+from pyrogram.raw.types import PeerChannel, PeerChat, PeerUser
+
+import editguard
+from editguard import ChatCounters, ChatLanes, EditJournal, MessageCache, MessageSnapshot, MessageStorage, UPDATES_DROPPED
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+# MessageCache
+
+def test_cache_evicts_least_recently_used():
+    cache = MessageCache(max_entries=2, max_bytes=1 << 20, ttl=60)
+    cache.put((1, 1), {"text": "a"})
+    cache.put((1, 2), {"text": "b"})
+    cache.get((1, 1))
+    cache.put((1, 3), {"text": "c"})
+
+    assert cache.peek((1, 1)) == {"text": "a"}
+    assert cache.peek((1, 2)) is None
+    assert len(cache) == 2
+
+
+def test_cache_evicts_over_byte_budget():
+    document = {"text": "x" * 1000}
+    cache = MessageCache(max_entries=100, max_bytes=MessageCache._estimate_size(document) * 2, ttl=60)
+    for message_id in range(3):
+        cache.put((1, message_id), dict(document))
+
+    assert len(cache) == 2
+    assert cache.size_bytes <= cache.max_bytes
+
+
+def test_cache_expires_entries_and_counts_misses():
+    cache = MessageCache(max_entries=10, max_bytes=1 << 20, ttl=60)
+    cache.put((1, 1), {"text": "a"}, ttl=-1)
+    cache.put((1, 2), {"text": "b"})
+
+    assert cache.get((1, 1)) is None
+    assert cache.get((1, 2)) == {"text": "b"}
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert len(cache) == 1
+
+
+def test_cache_peek_leaves_statistics_alone():
+    cache = MessageCache(max_entries=10, max_bytes=1 << 20, ttl=60)
+    cache.put((1, 1), {"text": "a"})
+
+    assert cache.peek((1, 1)) == {"text": "a"}
+    assert cache.peek((1, 2)) is None
+    assert (cache.hits, cache.misses) == (0, 0)
+
+
+def test_cache_dump_and_restore_keep_unexpired_entries():
+    cache = MessageCache(max_entries=10, max_bytes=1 << 20, ttl=60)
+    cache.put((1, 1), {"text": "a"})
+    cache.put((1, 2), {"text": "b"}, ttl=-1)
+
+    restored = MessageCache(max_entries=10, max_bytes=1 << 20, ttl=60)
+    assert restored.restore(cache.dump(), elapsed=1) == 1
+    assert restored.peek((1, 1)) == {"text": "a"}
+
+    # Entries that ran out while the bot was down are not brought back
+    assert MessageCache(max_entries=10, max_bytes=1 << 20, ttl=60).restore(cache.dump(), elapsed=120) == 0
+
+
+# ChatCounters
+
+def test_counters_prune_expired_buckets():
+    counters = ChatCounters()
+    now = datetime.utcnow()
+    counters.record_store(-100, now + timedelta(hours=2))
+    counters.record_store(-100, now + timedelta(hours=2))
+    counters.record_store(-100, now - timedelta(hours=2))
+    counters.record_store(-200, now + timedelta(hours=1))
+
+    assert counters.count(-100) == 2
+    assert counters.total() == 3
+    assert counters.top(1) == [(-100, 2)]
+
+
+def test_counters_restore_moves_bucket():
+    counters = ChatCounters()
+    now = datetime.utcnow()
+    counters.record_store(-100, now + timedelta(hours=2))
+    counters.record_restore(-100, now + timedelta(hours=2), now + timedelta(hours=5))
+
+    assert counters.count(-100) == 1
+    assert list(counters._buckets[-100]) == [counters._hour(now + timedelta(hours=5))]
+
+
+def test_counters_restore_of_expired_snapshot_counts_it_again():
+    counters = ChatCounters()
+    now = datetime.utcnow()
+    counters.record_restore(-100, now - timedelta(hours=2), now + timedelta(hours=2))
+
+    assert counters.count(-100) == 1
+
+
+def test_repeated_store_counts_once(monkeypatch):
+    monkeypatch.setattr(editguard, "chat_counters", ChatCounters())
+    monkeypatch.setattr(editguard, "message_cache", MessageCache(max_entries=10, max_bytes=1 << 20, ttl=60))
+    monkeypatch.setattr(MessageStorage, "_pending", {})
+
+    run(MessageStorage.store_message(1, 42, -100, MessageSnapshot("hello")))
+    run(MessageStorage.store_message(1, 42, -100, MessageSnapshot("hello")))
+
+    assert editguard.chat_counters.count(-100) == 1
+
+
+# Sharding
+
+def test_shard_for_is_stable_and_in_range():
+    shards = [editguard.shard_for(chat_id, 4) for chat_id in range(-1000, 0)]
+
+    assert set(shards) == {0, 1, 2, 3}
+    assert shards == [editguard.shard_for(chat_id, 4) for chat_id in range(-1000, 0)]
+
+
+def test_shard_for_only_moves_chats_to_an_added_worker():
+    for chat_id in range(-1000, 0):
+        before, after = editguard.shard_for(chat_id, 4), editguard.shard_for(chat_id, 5)
+        assert after in (before, 4)
+
+
+@pytest.mark.parametrize("update, chat_id", [
+    (SimpleNamespace(message=SimpleNamespace(peer_id=PeerUser(user_id=5))), 5),
+    (SimpleNamespace(message=SimpleNamespace(peer_id=PeerChat(chat_id=7))), -7),
+    (SimpleNamespace(message=SimpleNamespace(peer_id=PeerChannel(channel_id=9))), -1000000000009),
+    (SimpleNamespace(peer=PeerChat(chat_id=7)), -7),
+    (SimpleNamespace(channel_id=9), -1000000000009),
+    (SimpleNamespace(chat_id=7), -7),
+    (SimpleNamespace(), None)
+])
+def test_raw_chat_id(update, chat_id):
+    assert editguard.raw_chat_id(update) == chat_id
+
+
+# ChatLanes
+
+def edit(edit_date=datetime(2024, 1, 1)):
+    return SimpleNamespace(edit_date=edit_date)
+
+
+async def blocked_lane(policy: str):
+    """A one-lane ChatLanes with room for two updates, whose worker is stuck on a first handler"""
+    gate = asyncio.Event()
+
+    async def handler(update):
+        await gate.wait()
+
+    lanes = ChatLanes(1, 2, policy)
+    await lanes.submit(-100, handler, edit())
+    await asyncio.sleep(0)
+    await lanes.submit(-100, handler, edit())
+    await lanes.submit(-100, handler, edit())
+    return lanes, handler, gate
+
+
+def test_lanes_reject_unknown_policy():
+    with pytest.raises(ValueError):
+        ChatLanes(1, 2, "panic")
+
+
+def test_lanes_drop_edits_when_full():
+    async def scenario():
+        lanes, handler, gate = await blocked_lane("drop_edits")
+        dropped = UPDATES_DROPPED.value(reason="edit_overflow")
+        await lanes.submit(-100, handler, edit(), edit=True)
+        assert UPDATES_DROPPED.value(reason="edit_overflow") == dropped + 1
+        assert lanes.saturated
+
+        # New messages still wait for room
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(lanes.submit(-100, handler, edit()), 0.05)
+        gate.set()
+        await lanes.stop(timeout=1)
+    run(scenario())
+
+
+@pytest.mark.parametrize("policy", ["block", "degrade"])
+def test_lanes_wait_for_room_when_full(policy):
+    async def scenario():
+        lanes, handler, gate = await blocked_lane(policy)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(lanes.submit(-100, handler, edit(), edit=True), 0.05)
+        gate.set()
+        await lanes.submit(-100, handler, edit(), edit=True)
+        await lanes.stop(timeout=1)
+        assert lanes.depth == 0
+    run(scenario())
+
+
+def test_lanes_shed_reaction_updates_first():
+    async def scenario():
+        gate = asyncio.Event()
+
+        async def handler(update):
+            await gate.wait()
+
+        lanes = ChatLanes(1, 4, "block")
+        await lanes.submit(-100, handler, edit())
+        await asyncio.sleep(0)
+        await lanes.submit(-100, handler, edit())
+        await lanes.submit(-100, handler, edit())
+        dropped = UPDATES_DROPPED.value(reason="reaction_only")
+        await lanes.submit(-100, handler, edit(None), edit=True)
+        assert UPDATES_DROPPED.value(reason="reaction_only") == dropped + 1
+        assert lanes.depth == 2
+        gate.set()
+        await lanes.stop(timeout=1)
+    run(scenario())
+
+
+def test_lanes_stop_drops_updates_after_timeout():
+    async def scenario():
+        lanes, handler, gate = await blocked_lane("block")
+        dropped = UPDATES_DROPPED.value(reason="shutdown")
+        await lanes.stop(timeout=0.05)
+        assert UPDATES_DROPPED.value(reason="shutdown") == dropped + 2
+
+        await lanes.submit(-100, handler, edit())
+        assert UPDATES_DROPPED.value(reason="shutdown") == dropped + 3
+    run(scenario())
+
+
+# EditJournal
+
+def edited_message():
+    return SimpleNamespace(id=5, chat=SimpleNamespace(id=-100), from_user=SimpleNamespace(id=42, first_name="Alice"))
+
+
+def journal_record(monkeypatch, original_data: dict, snapshot: MessageSnapshot) -> dict:
+    monkeypatch.setattr(EditJournal, "_pending", [])
+    run(EditJournal.record(edited_message(), original_data, snapshot, "deleted"))
+    return EditJournal._pending[0]
+
+
+def test_journal_keeps_only_changed_text(monkeypatch):
+    original = {"text": "before", "media_type": None, "file_id": None, "user_id": 42}
+    record = journal_record(monkeypatch, original, MessageSnapshot("after"))
+
+    assert record["changes"] == {"text": "after"}
+    assert record["previous"] == {"text": "before"}
+    assert record["action"] == "deleted"
+
+
+def test_journal_keeps_media_fields_together(monkeypatch):
+    original = {"text": "caption", "media_type": "photo", "file_id": "old", "user_id": 42}
+    record = journal_record(monkeypatch, original, MessageSnapshot("caption", "photo", True, "new"))
+
+    assert record["changes"] == {"media_type": "photo", "file_id": "new"}
+    assert record["previous"] == {"media_type": "photo", "file_id": "old"}
+
+
+def test_journal_records_new_values_for_digests(monkeypatch):
+    original = {"u": 42, "h": b"digest"}
+    record = journal_record(monkeypatch, original, MessageSnapshot("after"))
+
+    assert record["changes"] == {"text": "after"}
+    assert record["previous"] == {}
@@ -0,0 +1,154 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from storage import SQLiteBackend, create_backend
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def backend():
+    backend = SQLiteBackend(":memory:")
+    run(backend.ensure_indexes())
+    yield backend
+    run(backend.close())
+
+
+def snapshot(chat_id, message_id, text="hello", expire_in=timedelta(days=1)):
+    now = datetime.utcnow()
+    return {
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "text": text,
+        "user_id": 42,
+        "media_type": None,
+        "has_media": False,
+        "file_id": None,
+        "timestamp": now,
+        "expire_at": now + expire_in
+    }
+
+
+def history_record(chat_id, message_id, edited_at, action="deleted", expire_in=timedelta(days=1)):
+    return {
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "user_id": 42,
+        "name": "Alice",
+        "action": action,
+        "changes": {"text": "after"},
+        "previous": {"text": "before"},
+        "edited_at": edited_at,
+        "expire_at": edited_at + expire_in
+    }
+
+
+def test_write_and_find_full_snapshot(backend):
+    document = snapshot(-100, 1)
+    run(backend.write_batch([document]))
+
+    found = run(backend.find(-100, 1))
+    assert found["text"] == "hello"
+    assert found["user_id"] == 42
+    assert found["has_media"] is False
+    assert abs(found["expire_at"] - document["expire_at"]) < timedelta(milliseconds=1)
+    assert run(backend.find(-100, 2)) is None
+
+
+def test_write_and_find_compact_snapshot(backend):
+    document = {"chat_id": -100, "message_id": 1, "u": 42, "h": b"\x01\x02", "expire_at": datetime.utcnow() + timedelta(days=1)}
+    run(backend.write_batch([document]))
+
+    found = run(backend.find(-100, 1))
+    assert found["u"] == 42
+    assert found["h"] == b"\x01\x02"
+    assert "text" not in found
+
+
+def test_write_batch_replaces_existing_snapshot(backend):
+    run(backend.write_batch([snapshot(-100, 1, "first")]))
+    run(backend.write_batch([snapshot(-100, 1, "second")]))
+
+    assert run(backend.find(-100, 1))["text"] == "second"
+    assert sum(run(backend.rebuild_counters())[-100]["buckets"].values()) == 1
+
+
+def test_purge_expired_removes_messages_and_history(backend):
+    now = datetime.utcnow()
+    run(backend.write_batch([snapshot(-100, 1, expire_in=-timedelta(hours=1)), snapshot(-100, 2)]))
+    run(backend.write_history([
+        history_record(-100, 1, now - timedelta(days=2), expire_in=timedelta(days=1)),
+        history_record(-100, 2, now)
+    ]))
+
+    assert run(backend.purge_expired(100)) == 2
+    assert run(backend.find(-100, 1)) is None
+    assert run(backend.find(-100, 2)) is not None
+    assert [record["message_id"] for record in run(backend.find_history(-100))] == [2]
+
+
+def test_purge_expired_respects_batch_size(backend):
+    run(backend.write_batch([snapshot(-100, message_id, expire_in=-timedelta(hours=1)) for message_id in range(5)]))
+
+    assert run(backend.purge_expired(2)) == 2
+    assert run(backend.purge_expired(10)) == 3
+
+
+def test_find_history_newest_first_with_limit(backend):
+    now = datetime.utcnow()
+    run(backend.write_history([history_record(-100, message_id, now + timedelta(seconds=message_id)) for message_id in range(5)]))
+    run(backend.write_history([history_record(-200, 1, now)]))
+
+    records = run(backend.find_history(-100, limit=3))
+    assert [record["message_id"] for record in records] == [4, 3, 2]
+    assert records[0]["changes"] == {"text": "after"}
+    assert records[0]["previous"] == {"text": "before"}
+
+    assert [record["message_id"] for record in run(backend.find_history(-100, 1))] == [1]
+
+
+def test_history_table_without_previous_column_is_migrated():
+    backend = SQLiteBackend(":memory:")
+    run(backend._run(lambda: backend._connection().execute("""
+        CREATE TABLE history (
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            user_id INTEGER,
+            name TEXT,
+            action TEXT NOT NULL,
+            changes TEXT NOT NULL,
+            edited_at REAL NOT NULL,
+            expire_at REAL NOT NULL
+        )
+    """)))
+    run(backend.ensure_indexes())
+
+    run(backend.write_history([history_record(-100, 1, datetime.utcnow())]))
+    assert run(backend.find_history(-100))[0]["previous"] == {"text": "before"}
+    run(backend.close())
+
+
+def test_counters_round_trip_and_rebuild(backend):
+    run(backend.save_counters({-100: {"title": "Group", "buckets": {500000: 3, 500001: 1}}}))
+    assert run(backend.load_counters()) == {-100: {"title": "Group", "buckets": {500000: 3, 500001: 1}}}
+
+    run(backend.write_batch([snapshot(-100, 1), snapshot(-100, 2), snapshot(-200, 1)]))
+    rebuilt = run(backend.rebuild_counters())
+    assert sum(rebuilt[-100]["buckets"].values()) == 2
+    assert sum(rebuilt[-200]["buckets"].values()) == 1
+
+
+def test_settings_round_trip(backend):
+    run(backend.save_settings(-100, {"enabled": False, "exempt": [1, 2]}))
+    run(backend.save_settings(-100, {"enabled": True, "exempt": [1]}))
+
+    assert run(backend.load_settings()) == {-100: {"enabled": True, "exempt": [1]}}
+
+
+def test_create_backend_rejects_unknown_name():
+    with pytest.raises(ValueError):
+        create_backend("redis", "", ":memory:", timedelta(days=1), False)